@@ -0,0 +1,312 @@
+#! /usr/bin/python
+
+import sys
+import os
+import json
+import time
+import shutil
+import resource
+import tempfile
+import subprocess
+
+"""
+Benchmark the decoders of h1-h4 on the bundled data.
+
+Each benchmark runs in its own python process (started in its homework
+directory), so peak RSS is measured per benchmark and modules of the same
+name in different homework directories do not clash. Model training is
+setup and is not timed, except for the h3 EM and h4 perceptron benchmarks
+which time training itself.
+
+    python benchmark.py                          # run all benchmarks
+    python benchmark.py h1.viterbi h2.cky        # run some of them
+    python benchmark.py --save baseline.json     # store results
+    python benchmark.py --baseline baseline.json # compare with stored results
+
+With --baseline the exit status is 1 if a benchmark is slower or uses more
+memory than the baseline by more than --tolerance.
+"""
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+TOLERANCE = 0.1  # allowed relative regression
+
+# name: (homework directory, default number of sentences, description)
+BENCHMARKS = [
+    ('h1.viterbi', 'h1', None, 'HMM Viterbi (log space), gene.dev'),
+    ('h1.compiled', 'h1', None, 'compiled HMM Viterbi, gene.dev'),
+    ('h2.cky', 'h2', None, 'PCFG CKY, parse_dev.dat'),
+    ('h2.compiled', 'h2', None, 'compiled PCFG CKY, parse_dev.dat'),
+    ('h3.em', 'h3', 1000, 'IBM model 1, one EM iteration, corpus'),
+    ('h3.align', 'h3', None, 'IBM model 1 alignment, dev'),
+    ('h4.viterbi', 'h4', None, 'GLM Viterbi, gene.dev'),
+    ('h4.perceptron', 'h4', 1000, 'GLM perceptron, one iteration, gene.train'),
+]
+
+
+def head(items, limit):
+    return items if limit is None else items[:limit]
+
+
+def time_each(decode, sents):
+    """
+    decode each sentence, return the per-sentence latencies in seconds
+    """
+    latencies = []
+    for sent in sents:
+        start = time.time()
+        decode(sent)
+        latencies.append(time.time() - start)
+    return latencies
+
+
+def h1_sents(limit):
+    import util
+    return head(list(util.test_sent_iterator(util.test_data_iterator(file('gene.dev')))), limit)
+
+
+def h1_tagger():
+    from hmm import ViterbiTagger
+    tagger = ViterbiTagger(3, log_space=True)
+    tagger.train_rare(file('gene.train'))
+    return tagger
+
+
+def bench_h1_viterbi(limit):
+    tagger = h1_tagger()
+    sents = h1_sents(limit)
+    return sents, time_each(tagger.viterbi, sents)
+
+
+def bench_h1_compiled(limit):
+    from compiled_hmm import CompiledHmm
+    tagger = CompiledHmm(h1_tagger())
+    sents = h1_sents(limit)
+    return sents, time_each(tagger.viterbi, sents)
+
+
+def h2_tagger():
+    import pcfg
+    trees = [json.loads(l) for l in open('parse_train.dat')]
+    counts = pcfg.PCFG()
+    for tree in trees:
+        counts.count(tree)
+    counts.count_word()
+    rare_words = set(counts.rare_words)
+    for tree in trees:
+        pcfg.replace(tree, rare_words, pcfg.rare_words_rule_p1)
+    tagger = pcfg.CKYTagger()
+    for tree in trees:
+        tagger.count(tree)
+    tagger.count_word()
+    tagger.cal_rule_params()
+    return tagger
+
+
+def bench_h2_cky(limit):
+    tagger = h2_tagger()
+    lines = head(open('parse_dev.dat').readlines(), limit)
+    return [l.split() for l in lines], time_each(tagger.CKY, lines)
+
+
+def bench_h2_compiled(limit):
+    from compiled_pcfg import CompiledPCFG
+    tagger = CompiledPCFG(h2_tagger())
+    lines = head(open('parse_dev.dat').readlines(), limit)
+    return [l.split() for l in lines], time_each(tagger.CKY, lines)
+
+
+def h3_ibm1(limit, workdir):
+    """
+    return an IBM object for IBM model 1 on the first limit sentence pairs
+    of the corpus, changes to workdir where EM writes its model files
+    """
+    from p12 import IBM1, IBM
+    for name in ('corpus.en', 'corpus.es'):
+        output = file(os.path.join(workdir, name), 'w')
+        output.writelines(head(file(name).readlines(), limit))
+        output.close()
+    os.chdir(workdir)
+    mt = IBM(IBM1())
+    mt.read_file('corpus.en', 'corpus.es')
+    return mt
+
+
+def bench_h3_em(limit):
+    cwd, workdir = os.getcwd(), tempfile.mkdtemp()
+    try:
+        mt = h3_ibm1(limit, workdir)
+        start = time.time()
+        mt.EM(1)
+        return [f for e, f in mt.text], time.time() - start
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir)
+
+
+def bench_h3_align(limit):
+    dev = [([w.strip() for w in ['*'] + e.split(' ')], [w.strip() for w in f.split(' ')])
+           for e, f in zip(open('dev.en'), open('dev.es'))]
+    cwd, workdir = os.getcwd(), tempfile.mkdtemp()
+    try:
+        mt = h3_ibm1(None, workdir)
+        mt.EM(1)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir)
+    model = mt.model
+
+    def align(pair):
+        # as IBM.read_dev_file
+        e, f = pair
+        l, m = len(e), len(f)
+        for i, fword in enumerate(f):
+            total, vals = model.prob_list(fword, e, i, l, m)
+            max(vals, key=(lambda x: vals[x]))
+
+    dev = head(dev, limit)
+    return [f for e, f in dev], time_each(align, dev)
+
+
+def bench_h4_viterbi(limit):
+    from glm import read_sentences, read_tag_model, transition_scores, viterbi
+    model = read_tag_model('tag.model')
+    transitions = transition_scores(model)
+    sents = head(read_sentences('gene.dev'), limit)
+    return sents, time_each(lambda sent: viterbi(sent, model, transitions), sents)
+
+
+def bench_h4_perceptron(limit):
+    from glm import read_sentence_tags, perceptron
+    sents, tag_lines = read_sentence_tags('gene.train')
+    sents, tag_lines = head(sents, limit), head(tag_lines, limit)
+    start = time.time()
+    perceptron(sents, tag_lines, 1)
+    return sents, time.time() - start
+
+
+def percentile(values, p):
+    """
+    nearest-rank percentile of a sorted list
+    """
+    return values[max(0, int(-(-p * len(values) // 100)) - 1)]
+
+
+def run_benchmark(name, limit):
+    """
+    run a benchmark in this process, return its results
+    a benchmark returns the sentences it processed and either the list of
+    per-sentence latencies or the total time
+    """
+    bench = globals()['bench_' + name.replace('.', '_')]
+    stdout, sys.stdout = sys.stdout, file(os.devnull, 'w')  # drivers print progress
+    try:
+        sents, timing = bench(limit)
+    finally:
+        sys.stdout = stdout
+    result = {'sentences': len(sents), 'tokens': sum(len(sent) for sent in sents)}
+    if isinstance(timing, list):
+        latencies = sorted(timing)
+        result['seconds'] = sum(latencies)
+        result['p50_ms'] = percentile(latencies, 50) * 1000
+        result['p99_ms'] = percentile(latencies, 99) * 1000
+    else:
+        result['seconds'] = timing
+    result['sents_per_sec'] = result['sentences'] / result['seconds']
+    result['tokens_per_sec'] = result['tokens'] / result['seconds']
+    result['peak_rss_kb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return result
+
+
+def spawn_benchmark(name, directory, limit):
+    """
+    run a benchmark in a new process started in its homework directory
+    """
+    command = [sys.executable, os.path.abspath(__file__), '--worker', name]
+    if limit is not None:
+        command += ['--sentences', str(limit)]
+    output = subprocess.check_output(command, cwd=os.path.join(ROOT, directory))
+    return json.loads(output)
+
+
+# (key, higher is better)
+COMPARED = [('tokens_per_sec', True), ('sents_per_sec', True),
+            ('p50_ms', False), ('p99_ms', False), ('peak_rss_kb', False)]
+
+
+def compare(results, baseline, tolerance=TOLERANCE):
+    """
+    return a list of (name, key, baseline value, value) of results worse
+    than baseline by more than tolerance
+    """
+    regressions = []
+    for name, result in sorted(results.iteritems()):
+        if name not in baseline:
+            continue
+        if (result['sentences'], result['tokens']) != (baseline[name]['sentences'], baseline[name]['tokens']):
+            sys.stderr.write('WARNING: {0} ran on different data than the baseline\n'.format(name))
+        for key, higher_is_better in COMPARED:
+            if key not in result or key not in baseline[name]:
+                continue
+            old, new = baseline[name][key], result[key]
+            change = (old - new) / old if higher_is_better else (new - old) / old
+            if change > tolerance:
+                regressions.append((name, key, old, new))
+    return regressions
+
+
+def write_report(results, output=sys.stdout, baseline=None):
+    keys = ['sentences', 'tokens', 'seconds', 'tokens_per_sec', 'sents_per_sec', 'p50_ms', 'p99_ms', 'peak_rss_kb']
+    output.write('{0:<15}'.format('benchmark') + ''.join('{0:>15}'.format(key) for key in keys) + '\n')
+    for name, result in sorted(results.iteritems()):
+        output.write('{0:<15}'.format(name))
+        for key in keys:
+            output.write('{0:>15}'.format('{0:.6g}'.format(result[key]) if key in result else '-'))
+        output.write('\n')
+        if baseline and name in baseline:
+            output.write('{0:<15}'.format('  baseline'))
+            for key in keys:
+                value = baseline[name].get(key)
+                output.write('{0:>15}'.format('-' if value is None else '{0:.6g}'.format(value)))
+            output.write('\n')
+
+
+if __name__ == "__main__":
+    import argparse
+
+    names = [b[0] for b in BENCHMARKS]
+    parser = argparse.ArgumentParser(description='benchmark the decoders of h1-h4')
+    parser.add_argument('benchmarks', nargs='*', help='benchmarks to run (default: all): ' + ', '.join(names))
+    parser.add_argument('--sentences', help='number of sentences per benchmark (default: per benchmark)', type=int)
+    parser.add_argument('--save', help='write results as JSON to this file')
+    parser.add_argument('--baseline', help='compare with results stored by --save')
+    parser.add_argument('--tolerance', help='allowed relative regression (default: %g)' % TOLERANCE,
+                        type=float, default=TOLERANCE)
+    parser.add_argument('--worker', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        sys.path.insert(0, os.getcwd())
+        print json.dumps(run_benchmark(args.worker, args.sentences))
+        sys.exit(0)
+
+    for name in args.benchmarks:
+        if name not in names:
+            parser.error('unknown benchmark: ' + name)
+
+    results = {}
+    for name, directory, limit, description in BENCHMARKS:
+        if args.benchmarks and name not in args.benchmarks:
+            continue
+        sys.stderr.write('{0}: {1}\n'.format(name, description))
+        results[name] = spawn_benchmark(name, directory, args.sentences or limit)
+
+    baseline = json.load(open(args.baseline)) if args.baseline else None
+    write_report(results, baseline=baseline)
+    if args.save:
+        json.dump(results, open(args.save, 'w'), indent=2, sort_keys=True)
+    if baseline:
+        regressions = compare(results, baseline, args.tolerance)
+        for name, key, old, new in regressions:
+            print 'REGRESSION {0} {1}: {2:.6g} -> {3:.6g}'.format(name, key, old, new)
+        if regressions:
+            sys.exit(1)
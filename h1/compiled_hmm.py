@@ -0,0 +1,345 @@
+#! /usr/bin/python
+
+import json
+import struct
+import numpy as np
+import util
+import instrument
+
+"""
+Compiled trigram HMM: tags and words are mapped to integer indexes and the
+params of a trained Hmm_ex are stored as dense log-probability arrays, so the
+Viterbi recursion runs as one broadcasted max/argmax per position.
+"""
+
+LOG_ZERO = float('-inf')
+START = '*'
+STOP = 'STOP'
+BUCKET_WINDOW = 32  # batches read ahead and sorted by length in tag()
+MODEL_MAGIC = 'HMMCMPL1'  # first bytes of a compiled model file
+ALIGNMENT = 64  # byte alignment of the sections of a compiled model file
+
+
+def _aligned(size):
+    return (size + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+class CompiledHmm(object):
+    """
+    Dense log-space params of a trigram HMM
+
+    states = tags + ['*']; the last index of the w and u axes is '*'
+    and the last index of the v axis is STOP.
+    log_q[w, u, v] = log q(v|w, u)
+    log_e[x, v] = log e(x|v), the last row is an all zero-probability
+    row used for words that have no emission at all
+    """
+    def __init__(self, hmm):
+        # keep the iteration order of hmm.tags, so ties are broken
+        # the same way as in ViterbiTagger
+        tags = list(hmm.tags)
+        words = list(hmm.words)
+        tag_index = dict((t, i) for i, t in enumerate(tags))
+        tag_index[START] = tag_index[STOP] = len(tags)
+        word_index = dict((w, i) for i, w in enumerate(words))
+
+        # row of log_e for each word of the model, rare words use the
+        # row of their rare word class
+        word_rows = np.arange(len(words), dtype=np.int64)
+        for w in hmm.rare_words:
+            word_rows[word_index[w]] = word_index.get(hmm.rare_words_rule(w), len(words))
+
+        T = len(tags)
+        log_q = np.full((T + 1, T + 1, T + 1), LOG_ZERO)
+        for (w, u, v), p in hmm.q_3_gram.iteritems():
+            if p > 0.0:
+                log_q[tag_index[w], tag_index[u], tag_index[v]] = np.log(p)
+
+        log_e = np.full((len(words) + 1, T), LOG_ZERO)
+        for (x, v), p in hmm.emission_params.iteritems():
+            if p > 0.0:
+                log_e[word_index[x], tag_index[v]] = np.log(p)
+
+        self.set_params(tags, words, word_rows, log_q, log_e, hmm.rare_words_rule)
+
+    def set_params(self, tags, words, word_rows, log_q, log_e, rare_words_rule):
+        self.tags = tags
+        self.states = self.tags + [START]
+        self.tag_index = dict((t, i) for i, t in enumerate(self.tags))
+        self.tag_index[START] = len(self.tags)
+        self.tag_index[STOP] = len(self.tags)
+        self.words = words
+        self.word_index = dict((w, i) for i, w in enumerate(self.words))
+        self.word_rows = dict(zip(self.words, word_rows.tolist()))
+        self.unseen_word_rows = util.LRUCache()  # unseen word -> row of its rare word class
+        self.rare_words_rule = rare_words_rule
+        self.log_q = log_q
+        self.log_e = log_e
+
+    def save(self, model_file):
+        """
+        write the model in the compiled format, see load()
+        """
+        sections = [
+            ('tags', '\n'.join(self.tags)),
+            ('words', '\n'.join(self.words)),
+            ('word_rows', np.array([self.word_rows[w] for w in self.words], dtype=np.int64)),
+            ('log_q', np.ascontiguousarray(self.log_q, dtype=np.float64)),
+            ('log_e', np.ascontiguousarray(self.log_e, dtype=np.float64))]
+        header = {'rare_words_rule': self.rare_words_rule.__name__}
+        # sections start after the header, so the header is laid out
+        # with offsets relative to the data start first
+        offset = 0
+        for name, data in sections:
+            if isinstance(data, np.ndarray):
+                header[name] = [offset, data.nbytes, data.dtype.str, data.shape]
+                size = data.nbytes
+            else:
+                header[name] = [offset, len(data)]
+                size = len(data)
+            offset += _aligned(size)
+        header_data = json.dumps(header)
+        data_start = _aligned(len(MODEL_MAGIC) + 8 + len(header_data))
+
+        model_file.write(MODEL_MAGIC)
+        model_file.write(struct.pack('<Q', len(header_data)))
+        model_file.write(header_data)
+        model_file.write('\0' * (data_start - len(MODEL_MAGIC) - 8 - len(header_data)))
+        for name, data in sections:
+            data = data.tostring() if isinstance(data, np.ndarray) else data
+            model_file.write(data)
+            model_file.write('\0' * (_aligned(len(data)) - len(data)))
+
+    @classmethod
+    def load(cls, model_filename):
+        """
+        load a model written by save(). log_q, log_e and the word rows are
+        memory-mapped, nothing is recomputed.
+
+        file layout: MODEL_MAGIC, header length (uint64), JSON header,
+        then the sections, each aligned to ALIGNMENT bytes. The header
+        gives offset (relative to the first section) and size of each
+        section, and dtype and shape of the array sections.
+        """
+        with open(model_filename, 'rb') as model_file:
+            if model_file.read(len(MODEL_MAGIC)) != MODEL_MAGIC:
+                raise ValueError('not a compiled HMM model: {0}'.format(model_filename))
+            header_length = struct.unpack('<Q', model_file.read(8))[0]
+            header = json.loads(model_file.read(header_length))
+            data_start = _aligned(len(MODEL_MAGIC) + 8 + header_length)
+
+            def read_strings(name):
+                offset, size = header[name]
+                model_file.seek(data_start + offset)
+                data = model_file.read(size)
+                return data.split('\n') if data else []
+
+            tags = read_strings('tags')
+            words = read_strings('words')
+
+        def map_array(name):
+            offset, size, dtype, shape = header[name]
+            return np.memmap(model_filename, dtype=np.dtype(str(dtype)), mode='r',
+                             offset=data_start + offset, shape=tuple(shape))
+
+        model = cls.__new__(cls)
+        model.set_params(tags, words, map_array('word_rows'), map_array('log_q'), map_array('log_e'),
+                         getattr(util, str(header['rare_words_rule'])))
+        return model
+
+    def word_id(self, x):
+        """
+        row of log_e used for word x, rare and unseen words are
+        replaced by their rare word class first
+        """
+        row = self.word_rows.get(x)
+        if row is None:
+            row = self.unseen_word_rows.get(x)
+            if row is None:
+                row = self.word_index.get(self.rare_words_rule(x), len(self.words))
+                self.unseen_word_rows.put(x, row)
+        return row
+
+    def word_ids(self, sent):
+        return np.array([self.word_id(x) for x in sent], dtype=np.intp)
+
+    def tag(self, test_data_file, result_file, batch_size=1, with_logprob=False):
+        """
+        tag a test file, batch_size sentences are decoded at once
+        with_logprob adds a third column: the log posterior of each tag
+        (the format eval_gene_tagger.corpus_iterator reads with with_logprob)
+        """
+        decode_batch = with_logprob and self.viterbi_posterior_batch or self.viterbi_batch
+        sent_iterator = util.test_sent_iterator(
+            util.test_data_iterator(test_data_file))
+
+        def tag_window(window):
+            instrument.count('sentences', len(window))
+            instrument.count('tokens', sum(len(sent) for sent in window))
+            with instrument.timer('decode'):
+                results = self.map_batches(decode_batch, window, batch_size)
+            with instrument.timer('output'):
+                self.write_tags(window, results, result_file, with_logprob)
+
+        window = []
+        for sent in sent_iterator:
+            window.append(sent)
+            if len(window) == batch_size * BUCKET_WINDOW:
+                tag_window(window)
+                window = []
+        if window:
+            tag_window(window)
+
+    def write_tags(self, sents, results, result_file, with_logprob=False):
+        for sent, result in zip(sents, results):
+            if with_logprob:
+                for s, t, p in zip(sent, *result):
+                    result_file.write('{0} {1} {2}\n'.format(s, t, p))
+            else:
+                for s, t in zip(sent, result):
+                    result_file.write('{0} {1}\n'.format(s, t))
+            result_file.write('\n')
+
+    def viterbi_sents(self, sents, batch_size):
+        """
+        tag a list of sentences, sentences of similar length are
+        grouped into batches of batch_size
+        return tag sequences in the order of sents
+        """
+        return self.map_batches(self.viterbi_batch, sents, batch_size)
+
+    def map_batches(self, decode_batch, sents, batch_size):
+        """
+        apply decode_batch to batches of batch_size sentences of similar length
+        return the results in the order of sents
+        """
+        order = sorted(xrange(len(sents)), key=lambda i: len(sents[i]))
+        result = [None] * len(sents)
+        for b in xrange(0, len(order), batch_size):
+            batch = order[b:b + batch_size]
+            for i, r in zip(batch, decode_batch([sents[i] for i in batch])):
+                result[i] = r
+        return result
+
+    def viterbi(self, sent):
+        """
+        tag a sentence using Viterbi algorithm
+        return tag sequence
+        """
+        return self.viterbi_batch([sent])[0]
+
+    def pad_batch(self, sents):
+        """
+        return (lengths, word rows padded to the longest sentence)
+        """
+        lengths = np.array([len(sent) for sent in sents], dtype=np.intp)
+        x = np.full((len(sents), lengths.max()), len(self.words), dtype=np.intp)
+        for b, sent in enumerate(sents):
+            x[b, :len(sent)] = self.word_ids(sent)
+        return lengths, x
+
+    def viterbi_batch(self, sents):
+        """
+        tag a batch of sentences using Viterbi algorithm
+        pi[b, u, v] is the best log-probability of a tag sequence of
+        sentence b ending with u, v. Sentences shorter than the longest one
+        are padded, pi is carried over unchanged at padded positions.
+        return tag sequences
+        """
+        B = len(sents)
+        T = len(self.tags)
+        lengths, x = self.pad_batch(sents)
+        n_max = lengths.max()
+        log_q = self.log_q[:, :, :T]
+        pi = np.full((B, T + 1, T + 1), LOG_ZERO)
+        pi[:, T, T] = 0.0  # pi(0, *, *) = 1
+        bp = np.zeros((n_max + 1, B, T + 1, T), dtype=np.intp)
+        for k in xrange(1, n_max + 1):
+            # scores[b, w, u, v] = pi(k - 1, w, u) + log q(v|w, u) + log e(x_k|v)
+            scores = pi[:, :, :, np.newaxis] + log_q + self.log_e[x[:, k - 1]][:, np.newaxis, np.newaxis, :]
+            bp[k] = scores.argmax(axis=1)
+            pi_k = np.full((B, T + 1, T + 1), LOG_ZERO)
+            pi_k[:, :, :T] = scores.max(axis=1)
+            active = (lengths >= k)[:, np.newaxis, np.newaxis]
+            pi = np.where(active, pi_k, pi)
+        instrument.count('viterbi_cells', n_max * pi.size)  # padded positions included
+        # trace back
+        # u = '*' is only reachable at the end of a one-word sentence
+        final = (pi[:, :, :T] + self.log_q[:, :T, T]).reshape(B, (T + 1) * T).argmax(axis=1)
+        results = []
+        for b in xrange(B):
+            n = lengths[b]
+            result = range(0, n + 1)
+            u, result[n] = divmod(final[b], T)
+            if n > 1:
+                result[n - 1] = u
+            for k in xrange(n - 2, 0, -1):
+                result[k] = bp[k + 2, b, result[k + 1], result[k + 2]]
+            results.append([self.tags[t] for t in result[1:]])
+        return results
+
+    def forward_backward(self, sent):
+        """
+        posteriors of a sentence, see forward_backward_batch
+        return (sentence log-likelihood, log posteriors: n x |T| array)
+        """
+        log_z, posteriors = self.forward_backward_batch([sent])
+        return log_z[0], posteriors[0, :len(sent)]
+
+    def forward_backward_batch(self, sents):
+        """
+        forward-backward algorithm in log space over a padded batch
+        alpha[k, b, u, v]: log-probability of x_1..x_k with tags ending u, v
+        beta[k, b, u, v]: log-probability of x_k+1..x_n, STOP given u, v
+        return (log p(x) of each sentence,
+                log p(y_k = v|x): B x n_max x |T| array, -inf at padded positions)
+        """
+        B = len(sents)
+        T = len(self.tags)
+        lengths, x = self.pad_batch(sents)
+        n_max = lengths.max()
+        log_q = self.log_q[:, :, :T]
+        stop = self.log_q[:, :, T]
+        alpha = np.full((n_max + 1, B, T + 1, T + 1), LOG_ZERO)
+        alpha[0, :, T, T] = 0.0
+        for k in xrange(1, n_max + 1):
+            # alpha[k, b, u, v] = log sum_w exp(alpha[k - 1, b, w, u] + log q(v|w, u)) + log e(x_k|v)
+            alpha[k, :, :, :T] = logsumexp(alpha[k - 1, :, :, :, np.newaxis] + log_q, axis=1) \
+                + self.log_e[x[:, k - 1]][:, np.newaxis, :]
+        beta = np.full((n_max + 1, B, T + 1, T + 1), LOG_ZERO)
+        for k in xrange(n_max, 0, -1):
+            if k < n_max:
+                # beta[k, b, u, v] = log sum_v' exp(log q(v'|u, v) + log e(x_k+1|v') + beta[k + 1, b, v, v'])
+                inside = logsumexp(log_q + self.log_e[x[:, k]][:, np.newaxis, np.newaxis, :]
+                                   + beta[k + 1, :, np.newaxis, :, :T], axis=3)
+                beta[k] = np.where((lengths > k)[:, np.newaxis, np.newaxis], inside, LOG_ZERO)
+            beta[k, lengths == k] = stop  # beta[n] = log q(STOP|u, v)
+        last = alpha[lengths, np.arange(B)]
+        log_z = logsumexp((last + stop).reshape(B, -1), axis=1)
+        # log p(y_k = v|x) = log sum_u exp(alpha[k, u, v] + beta[k, u, v]) - log p(x)
+        posteriors = logsumexp(alpha[1:, :, :, :T] + beta[1:, :, :, :T], axis=2) - log_z[:, np.newaxis]
+        posteriors = np.minimum(posteriors, 0.0)  # rounding can leave a sure tag slightly above 0
+        return log_z, posteriors.transpose(1, 0, 2)
+
+    def viterbi_posterior_batch(self, sents):
+        """
+        tag a batch of sentences using Viterbi algorithm
+        return [(tag sequence, log posterior of each tag)]
+        """
+        tags = self.viterbi_batch(sents)
+        log_z, posteriors = self.forward_backward_batch(sents)
+        results = []
+        for b, sent_tags in enumerate(tags):
+            rows = [self.tag_index[t] for t in sent_tags]
+            results.append((sent_tags, posteriors[b, np.arange(len(rows)), rows].tolist()))
+        return results
+
+
+def logsumexp(a, axis):
+    """
+    log(sum(exp(a), axis)), -inf if all of a is -inf along axis
+    """
+    m = a.max(axis=axis)
+    m[~np.isfinite(m)] = 0.0
+    with np.errstate(divide='ignore'):
+        return np.log(np.exp(a - np.expand_dims(m, axis)).sum(axis=axis)) + m
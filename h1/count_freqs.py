@@ -4,7 +4,10 @@ __author__="Daniel Bauer <bauer@cs.columbia.edu>"
 __date__ ="$Sep 12, 2011"
 
 import sys
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
+from StringIO import StringIO
+import multiprocessing
+import os
 import math
 
 """
@@ -12,6 +15,8 @@ Count n-gram frequencies in a data file and write counts to
 stdout. 
 """
 
+BLOCK_SIZE = 1 << 20 # Bytes read from the corpus file at a time by Hmm.train
+
 def simple_conll_corpus_iterator(corpus_file):
     """
     Get an iterator object over the corpus file. The elements of the
@@ -74,6 +79,58 @@ def get_ngrams(sent_iterator, n):
             yield n_gram        
 
 
+class OrderedCounts(OrderedDict):
+    """
+    Counts that remember the order keys were first seen in.
+    """
+    def __missing__(self, key):
+        return 0
+
+
+def shard_offsets(corpus_filename, shards):
+    """
+    Split a corpus file into at most shards byte ranges (start, end) of
+    about equal size, each ending at a sentence boundary (blank line).
+    """
+    size = os.path.getsize(corpus_filename)
+    offsets = [0]
+    corpus_file = file(corpus_filename, "r")
+    for i in xrange(1, shards):
+        target = max(size * i // shards, offsets[-1])
+        corpus_file.seek(target)
+        if target > 0:
+            corpus_file.readline() # Skip to the start of the next line
+        l = corpus_file.readline()
+        while l and l.strip(): # Find the end of the current sentence
+            l = corpus_file.readline()
+        offset = corpus_file.tell()
+        if offset >= size:
+            break
+        if offset > offsets[-1]:
+            offsets.append(offset)
+    corpus_file.close()
+    offsets.append(size)
+    return zip(offsets[:-1], offsets[1:])
+
+
+def count_shard(args):
+    """
+    Count a byte range of a corpus file. Returns the emission and n-gram
+    counts as lists of (key, count) in the order keys were first seen.
+    """
+    corpus_filename, n, start, end = args
+    corpus_file = file(corpus_filename, "r")
+    corpus_file.seek(start)
+    shard = StringIO(corpus_file.read(end - start))
+    corpus_file.close()
+
+    counter = Hmm(n)
+    counter.emission_counts = OrderedCounts()
+    counter.ngram_counts = [OrderedCounts() for i in xrange(n)]
+    counter.train(shard)
+    return counter.emission_counts.items(), [counts.items() for counts in counter.ngram_counts]
+
+
 class Hmm(object):
     """
     Stores counts for n-grams and emissions. 
@@ -89,6 +146,98 @@ class Hmm(object):
     def train(self, corpus_file):
         """
         Count n-gram frequencies and emission probabilities from a corpus file.
+        The file is read in blocks of BLOCK_SIZE bytes and counted a sentence
+        at a time. Counts (and the order keys are first seen, so the output
+        of write_counts) are the same as train_iterators.
+        """
+        words, tags = [], []
+        rest = ""
+        while True:
+            block = corpus_file.read(BLOCK_SIZE)
+            if not block:
+                break
+            lines = (rest + block).split("\n")
+            rest = lines.pop() # Incomplete last line, completed by the next block
+            for line in lines:
+                line = line.strip()
+                if line: # Nonempty line: word ne_tag
+                    word, _, ne_tag = line.rpartition(" ")
+                    words.append(word)
+                    tags.append(ne_tag)
+                elif words: # Reached the end of a sentence
+                    self.count_sentence(words, tags)
+                    words, tags = [], []
+                else: # Got empty input stream
+                    sys.stderr.write("WARNING: Got empty input file/stream.\n")
+                    return
+        line = rest.strip()
+        if line:
+            word, _, ne_tag = line.rpartition(" ")
+            words.append(word)
+            tags.append(ne_tag)
+        if words:
+            self.count_sentence(words, tags)
+
+    def count_sentence(self, words, tags):
+        """
+        Count emissions and 1..n-grams of one sentence, given as its list of
+        words and list of tags. Each table gets its keys in the order
+        train_iterators would insert them.
+        """
+        n = self.n
+        emission_counts = self.emission_counts
+        for key in zip(words, tags):
+            emission_counts[key] += 1
+
+        # Add boundary symbols to the sentence
+        w_boundary = (n-1) * ["*"] + tags + ["STOP"]
+        ngrams = [[(tag,) for tag in tags]] # 1-grams: no STOP
+        for i in xrange(2, n+1): # NE-tag 2-grams..n-grams
+            ngrams.append(zip(*[w_boundary[j:] for j in xrange(n-i, n)]))
+
+        for i, keys in enumerate(ngrams):
+            counts = self.ngram_counts[i]
+            if i == n - 2:
+                # Need to count a single n-1-gram of sentence start symbols
+                # per sentence, right after the first n-gram of the sentence
+                counts[keys[0]] += 1
+                counts[tuple((n - 1) * ["*"])] += 1
+                keys = keys[1:]
+            for key in keys:
+                counts[key] += 1
+
+    def train_parallel(self, corpus_filename, processes=None):
+        """
+        Count n-gram frequencies and emission probabilities from a corpus file
+        with a pool of processes workers (default: number of CPUs). The file
+        is split at sentence boundaries into one shard per worker, and the
+        shard counts are merged in file order, so counts and write_counts
+        output are the same as train. (Shards are counted independently: a
+        stray empty line only stops counting of its own shard.)
+        """
+        if processes is None:
+            processes = multiprocessing.cpu_count()
+        shards = [(corpus_filename, self.n, start, end)
+                  for start, end in shard_offsets(corpus_filename, processes)]
+        pool = multiprocessing.Pool(processes)
+        try:
+            for emission_counts, ngram_counts in pool.imap(count_shard, shards):
+                for key, count in emission_counts:
+                    self.emission_counts[key] += count
+                for i, counts in enumerate(ngram_counts):
+                    for key, count in counts:
+                        self.ngram_counts[i][key] += count
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+
+    def train_iterators(self, corpus_file):
+        """
+        Count n-gram frequencies and emission probabilities from a corpus file.
+        Reference implementation of train, over the iterators above.
         """
         ngram_iterator = \
             get_ngrams(sentence_iterator(simple_conll_corpus_iterator(corpus_file)), self.n)
@@ -150,13 +299,14 @@ class Hmm(object):
 
 def usage():
     print """
-    python count_freqs.py [input_file] > [output_file]
+    python count_freqs.py [input_file] [processes] > [output_file]
         Read in a gene tagged training input file and produce counts.
+        With processes > 1, shards of the file are counted in parallel.
     """
 
 if __name__ == "__main__":
 
-    if len(sys.argv)!=2: # Expect exactly one argument: the training data file
+    if len(sys.argv) not in (2, 3): # Expect the training data file, and optionally the number of processes
         usage()
         sys.exit(2)
 
@@ -169,6 +319,11 @@ if __name__ == "__main__":
     # Initialize a trigram counter
     counter = Hmm(3)
     # Collect counts
-    counter.train(input)
+    processes = len(sys.argv) == 3 and int(sys.argv[2]) or 1
+    if processes > 1:
+        input.close()
+        counter.train_parallel(sys.argv[1], processes)
+    else:
+        counter.train(input)
     # Write the counts
     counter.write_counts(sys.stdout)
@@ -6,12 +6,18 @@ __date__ = "$March 16, 2013"
 from count_freqs import Hmm
 from collections import defaultdict
 import util
+import instrument
+import tracing
 from decimal import Decimal
+import math
 
 """
 extend Hmm provided by assigments
 """
 
+LOG_ZERO = float('-inf')
+NO_TRANSITIONS = {}  # transitions of a tag pair never seen as a history
+
 
 class Hmm_ex(Hmm):
     """
@@ -22,10 +28,19 @@ class Hmm_ex(Hmm):
 
         self.emission_params = defaultdict(float)  # e(x|y)
         self.word_counts = defaultdict(int)  # count(x)
-        self.rare_words = []
+        self.rare_words = set()
+        self.word_classes = {}  # word of the model -> word used for emission lookup
+        self.word_classes_rule = None  # rare_words_rule word_classes was built with
+        self.unseen_word_classes = util.LRUCache()  # unseen word -> rare word class
         self.tags = set()
         self.words = set()
         self.q_3_gram = defaultdict(float)
+        self.log_emission_params = {}  # log e(x|y), only nonzero entries
+        self.log_q_3_gram = {}  # log q(y_i|y_i-1, y_i-2), only nonzero entries
+        self.transitions = {}  # (y_i-2, y_i-1) -> {y_i: log q(y_i|y_i-2, y_i-1)}, only nonzero entries
+        self.emission_index = {}  # x -> [(y, log e(x|y))] for the y with e(x|y) > 0
+        self.words_by_tag = None  # y -> words emitted by y, built by update()
+        self.trigrams_by_context = None  # (w, u) -> v with count(w, u, v) > 0, built by update()
         self.rare_word_threshold = util.RARE_WORD_THRESHOLD
         self.rare_words_rule = util.rare_words_rule_p1
 
@@ -33,12 +48,136 @@ class Hmm_ex(Hmm):
         """
         Count n-gram frequencies and emission probabilities from a corpus file.
         """
-        super(Hmm_ex, self).train(corpus_file)
-        self.count_words()  # count(x)
-        self.get_rare_words(self.rare_word_threshold)  # rare word
-        self.cal_emission_param()  # e(x|y)
-        self.get_all_tags_and_words()  # get all tags and words
-        self.cal_q_3_gram()  # q(y_i|y_i-2, y_i_1)
+        with instrument.timer('count'):
+            super(Hmm_ex, self).train(corpus_file)
+        with instrument.timer('rare_words'):
+            self.count_words()  # count(x)
+            self.get_rare_words(self.rare_word_threshold)  # rare word
+        with instrument.timer('params'):
+            self.cal_emission_param()  # e(x|y)
+            self.get_all_tags_and_words()  # get all tags and words
+            self.build_word_classes()  # word -> word used for emission lookup
+            self.cal_q_3_gram()  # q(y_i|y_i-2, y_i_1)
+            self.cal_log_params()  # log e(x|y), log q(y_i|y_i-2, y_i_1)
+        self.words_by_tag = self.trigrams_by_context = None
+
+    def train_rare(self, corpus_file):
+        """
+        Count n-gram frequencies and emission probabilities from a corpus file,
+        with rare words replaced by their class under rare_words_rule.
+        Gives the counts of training on the corpus rewritten by
+        util.process_rare_words, with one read of the corpus and no
+        rewritten copy: the mapping only changes emission counts.
+        The written model has the same counts as the two-pass one, but
+        the emission counts come out in a different order.
+        """
+        with instrument.timer('count'):
+            super(Hmm_ex, self).train(corpus_file)
+        with instrument.timer('rare_words'):
+            self.count_words()  # count(x)
+            self.get_rare_words(self.rare_word_threshold)  # rare word
+            self.map_rare_emission_counts()  # count(y->x) after the rare word rule
+            self.word_counts = defaultdict(int)
+            self.count_words()  # count(x) after the rare word rule
+            self.get_rare_words(self.rare_word_threshold)
+        with instrument.timer('params'):
+            self.cal_emission_param()  # e(x|y)
+            self.get_all_tags_and_words()  # get all tags and words
+            self.build_word_classes()  # word -> word used for emission lookup
+            self.cal_q_3_gram()  # q(y_i|y_i-2, y_i_1)
+            self.cal_log_params()  # log e(x|y), log q(y_i|y_i-2, y_i_1)
+        self.words_by_tag = self.trigrams_by_context = None
+
+    def update(self, sentences):
+        """
+        Add tagged sentences (lists of (word, tag)) to the counts and
+        update only what they affect: e(.|y) for their tags y, since
+        count(y) changed, q(.|w, u) for their tag bigrams (w, u), and
+        count(x), rare word membership and word class of their words.
+        The params are those of training on the old corpus plus the
+        sentences, so the sentences must be in the same form as that
+        corpus (e.g. with rare words already replaced).
+        """
+        if self.words_by_tag is None:
+            self.index_counts()
+        new_words, new_tags, contexts = set(), set(), set()
+        for sent in sentences:
+            words = [word for word, tag in sent]
+            tags = [tag for word, tag in sent]
+            self.count_sentence(words, tags)
+            for word, tag in sent:
+                self.word_counts[word] += 1
+                self.words_by_tag[tag].add(word)
+            new_words.update(words)
+            new_tags.update(tags)
+            w_boundary = ['*', '*'] + tags + ['STOP']
+            for c in zip(w_boundary, w_boundary[1:], w_boundary[2:]):
+                self.trigrams_by_context[c[0:2]].add(c[2])
+                contexts.add(c[0:2])
+        tags_added = not new_tags <= self.tags
+        self.tags.update(new_tags)
+        self.words.update(new_words)
+
+        # e(x|y) of the words emitted by the updated tags
+        affected_words = set()
+        for tag in new_tags:
+            count_y = float(self.ngram_counts[0][(tag,)])
+            for word in self.words_by_tag[tag]:
+                e = float(self.emission_counts[(word, tag)]) / count_y
+                self.emission_params[(word, tag)] = e
+                self.log_emission_params[(word, tag)] = math.log(e)
+            affected_words.update(self.words_by_tag[tag])
+
+        # q(v|w, u) of the updated contexts (w, u)
+        for c in contexts:
+            count_wu = float(self.ngram_counts[1][c])
+            for v in self.trigrams_by_context[c]:
+                q = float(self.ngram_counts[2][c + (v,)]) / count_wu
+                self.q_3_gram[c + (v,)] = q
+                self.log_q_3_gram[c + (v,)] = math.log(q)
+                self.transitions.setdefault(c, {})[v] = math.log(q)
+
+        if tags_added:
+            self.build_emission_index()  # the order of self.tags changed
+        else:
+            for word in affected_words:
+                self.emission_index[word] = [
+                    (tag, self.log_emission_params[(word, tag)])
+                    for tag in self.tags if (word, tag) in self.log_emission_params]
+
+        # rare words and word classes
+        if self.word_classes_rule is not self.rare_words_rule:
+            self.build_word_classes()
+        for word in new_words:
+            if self.word_counts[word] < self.rare_word_threshold:
+                self.rare_words.add(word)
+                self.word_classes[word] = self.rare_words_rule(word)
+            else:
+                self.rare_words.discard(word)
+                self.word_classes[word] = word
+        self.unseen_word_classes.clear()
+
+    def index_counts(self):
+        """
+        index emission counts by tag and trigram counts by their first two tags
+        """
+        self.words_by_tag = defaultdict(set)
+        for word, tag in self.emission_counts:
+            self.words_by_tag[tag].add(word)
+        self.trigrams_by_context = defaultdict(set)
+        for c in self.ngram_counts[2]:
+            self.trigrams_by_context[c[0:2]].add(c[2])
+
+    def map_rare_emission_counts(self):
+        """
+        count(y->x) of a corpus where rare words are replaced by their class
+        """
+        emission_counts = defaultdict(int)
+        for (word, tag), count in self.emission_counts.iteritems():
+            if word in self.rare_words:
+                word = self.rare_words_rule(word)
+            emission_counts[(word, tag)] += count
+        self.emission_counts = emission_counts
 
     def get_all_tags_and_words(self):
         for word, tag in self.emission_counts:
@@ -53,10 +192,39 @@ class Hmm_ex(Hmm):
             self.word_counts[word] += self.emission_counts[(word, tag)]
 
     def get_rare_words(self, threshold):
-        self.rare_words = []
+        self.rare_words = set()
         for word in self.word_counts:
             if self.word_counts[word] < threshold:
-                self.rare_words.append(word)
+                self.rare_words.add(word)
+
+    def build_word_classes(self):
+        '''
+        map each word of the model to the word used for emission lookup:
+        rare words to their rare word class, other words to themselves
+        '''
+        self.word_classes = {}
+        for word in self.words:
+            if word in self.rare_words:
+                self.word_classes[word] = self.rare_words_rule(word)
+            else:
+                self.word_classes[word] = word
+        self.word_classes_rule = self.rare_words_rule
+        self.unseen_word_classes.clear()
+
+    def map_word(self, x):
+        '''
+        word used for emission lookup of x, rare and unseen words are
+        replaced by their rare word class
+        '''
+        if self.word_classes_rule is not self.rare_words_rule:
+            self.build_word_classes()  # rare_words_rule was changed
+        c = self.word_classes.get(x)
+        if c is None:
+            c = self.unseen_word_classes.get(x)
+            if c is None:
+                c = self.rare_words_rule(x)
+                self.unseen_word_classes.put(x, c)
+        return c
 
     def cal_emission_param(self):
         """
@@ -75,19 +243,55 @@ class Hmm_ex(Hmm):
         for c in self.ngram_counts[2]:
             self.q_3_gram[c] = float(self.ngram_counts[2][c]) / float(self.ngram_counts[1][tuple(c[0:2])])
 
+    def cal_log_params(self):
+        """
+        log e(x|y) and log q(y_i|y_i-2, y_i_1), used by log-space decoding.
+        zero params are left out, a missing key means log(0)
+        """
+        self.log_emission_params = {}
+        for k, p in self.emission_params.iteritems():
+            if p > 0.0:
+                self.log_emission_params[k] = math.log(p)
+        self.log_q_3_gram = {}
+        self.transitions = {}
+        for k, p in self.q_3_gram.iteritems():
+            if p > 0.0:
+                self.log_q_3_gram[k] = math.log(p)
+                self.transitions.setdefault(k[0:2], {})[k[2]] = math.log(p)
+        self.build_emission_index()
+
+    def build_emission_index(self):
+        """
+        x -> [(y, log e(x|y))] over the tags y that can emit x,
+        in the iteration order of self.tags
+        """
+        self.emission_index = {}
+        for word in self.words:
+            self.emission_index[word] = []
+        for tag in self.tags:
+            for word in self.words:
+                e = self.log_emission_params.get((word, tag))
+                if e is not None:
+                    self.emission_index[word].append((tag, e))
+
     def read_counts(self, corpusfile):
-        super(Hmm_ex, self).read_counts(corpusfile)
+        with instrument.timer('load'):
+            super(Hmm_ex, self).read_counts(corpusfile)
 
         self.word_counts = defaultdict(int)
         self.emission_params = defaultdict(float)
-        self.rare_words = []
+        self.rare_words = set()
         self.q_3_gram = defaultdict(float)
 
-        self.cal_emission_param()
-        self.count_words()
-        self.get_rare_words(self.rare_word_threshold)
-        self.get_all_tags_and_words()
-        self.cal_q_3_gram()
+        with instrument.timer('params'):
+            self.cal_emission_param()
+            self.count_words()
+            self.get_rare_words(self.rare_word_threshold)
+            self.get_all_tags_and_words()
+            self.build_word_classes()
+            self.cal_q_3_gram()
+            self.cal_log_params()
+        self.words_by_tag = self.trigrams_by_context = None
 
     def print_emission_counts(self, output):
         for word, ne_tag in self.emission_counts:
@@ -140,6 +344,7 @@ class SimpleTagger(Hmm_ex):
         for word in word_iterator:
             max_e, max_y = -1.0, ''
             if word is not None:
+                instrument.count('tokens')
                 if word == util.RARE_TAG or word not in self.words:
                     max_y = max_rare_y
                 else:
@@ -149,23 +354,37 @@ class SimpleTagger(Hmm_ex):
                             max_e, max_y = e, tag
                 output.write('{0} {1}\n'.format(word, max_y))
             else:
+                instrument.count('sentences')
                 output.write('\n')
 
 
 class ViterbiTagger(Hmm_ex):
-    """docstring for ViterbiTagger"""
-    def __init__(self, n=3):
+    """
+    Viterbi tagger, decodes with Decimal products by default,
+    or with float log-probabilities when log_space is set.
+    Setting beam_size and/or beam_threshold switches to beam search
+    (in log space): after each position only the beam_size best (u, v)
+    states, and/or those within beam_threshold of the best one, are kept.
+    """
+    def __init__(self, n=3, log_space=False, beam_size=None, beam_threshold=None):
         super(ViterbiTagger, self).__init__(n)
+        self.log_space = log_space
+        self.beam_size = beam_size
+        self.beam_threshold = beam_threshold
 
     def tag(self, test_data_file, result_file):
         # get test sentence
         sent_iterator = util.test_sent_iterator(
             util.test_data_iterator(test_data_file))
         for sent in sent_iterator:
-            tags = self.viterbi(sent)
-            for s, t in zip(sent, tags):
-                result_file.write('{0} {1}\n'.format(s, t))
-            result_file.write('\n')
+            instrument.count('sentences')
+            instrument.count('tokens', len(sent))
+            with instrument.timer('decode'):
+                tags = self.viterbi(sent)
+            with instrument.timer('output'):
+                for s, t in zip(sent, tags):
+                    result_file.write('{0} {1}\n'.format(s, t))
+                result_file.write('\n')
 
     def viterbi(self, sent):
         """
@@ -173,6 +392,10 @@ class ViterbiTagger(Hmm_ex):
         apply only 3-gram
         return tag sequence
         """
+        if self.beam_size is not None or self.beam_threshold is not None:
+            return self.decode_beam(sent)[1]
+        if self.log_space:
+            return self.viterbi_log(sent)
         n = len(sent)
         pi = []
         bp = []
@@ -185,24 +408,15 @@ class ViterbiTagger(Hmm_ex):
             W = self.tags
             U = self.tags
             V = self.tags
-            x = sent[k - 1]
-            if x in self.rare_words or x not in self.words:
-                x = self.rare_words_rule(x)
+            x = self.map_word(sent[k - 1])
             if k == 1:
                 W = U = ('*',)
             if k == 2:
                 W = ('*',)
             for u in U:
                 for v in V:
-                    if util.DEBUG:
-                        print 'k = {0}, u = {1}, v = {2}'.format(k, u, v)
                     max_pi, max_w = -1.0, ''
                     for w in W:
-                        if util.DEBUG:
-                            print 'calculating Pi[{km1}, {w}, {u}] * q({v}|{w}, {u}) * e({x}|{v})'.format(km1=k-1, u=u, v=v, w=w, x=x)
-                            print 'Pi[{km1}, {w}, {u}] = {p}'.format(km1=k-1, w=w, u=u, p=Decimal(pi[k - 1][(w, u)]))
-                            print 'q({v}|{w}, {u}) = {p}'.format(v=v, w=w, u=u, p=Decimal(self.q_3_gram[(w, u, v)]))
-                            print 'e({x}|{v}) = {p}'.format(x=x, v=v, p=Decimal(self.emission_params[(x, v)]))
                         if self.emission_params[(x, v)] == 0.0:
                             continue
                         tmp = Decimal(pi[k - 1][(w, u)])  \
@@ -210,14 +424,10 @@ class ViterbiTagger(Hmm_ex):
                             * Decimal(self.emission_params[(x, v)])
                         if tmp > max_pi:
                             max_pi, max_w = tmp, w
-                    if util.DEBUG:
-                        print 'Pi[{k}, {u}, {v}] = {max}'.format(k=k, u=u, v=v, max=max_pi)
-                        print 'bp[{k}, {u}, {v}] = {bp}'.format(k=k, u=u, v=v, bp=max_w)
-                        print '\n'
                     pi[k][(u, v)] = max_pi
                     bp[k][(u, v)] = max_w
-            if util.DEBUG:
-                print '========================================='
+        if instrument.ENABLED:
+            instrument.count('viterbi_cells', sum(len(pi_k) for pi_k in pi))
         # trace back
         U = self.tags
         V = self.tags
@@ -232,4 +442,160 @@ class ViterbiTagger(Hmm_ex):
         result[n-1], result[n] = max_u, max_v
         for k in range(n-2, 0, -1):
             result[k] = bp[k+2][(result[k+1], result[k+2])]
+        if tracing.ENABLED:
+            self.trace_trellis(sent, pi, bp, max_pi, result[1:])
         return result[1:]
+
+    def trace_trellis(self, sent, pi, bp, max_pi, tags):
+        """
+        record a decoded sentence as trace events: one 'cell' event per
+        trellis entry pi(k, u, v) with its back pointer, then a 'sentence'
+        event with the best path
+        """
+        for k in range(1, len(pi)):
+            x = self.map_word(sent[k - 1])
+            for (u, v), p in sorted(pi[k].iteritems()):
+                tracing.event('cell', k=k, word=sent[k - 1], x=x, u=u, v=v, pi=p, bp=bp[k].get((u, v)))
+        tracing.event('sentence', words=sent, tags=tags, pi=max_pi)
+
+    def viterbi_log(self, sent):
+        """
+        tag a sentence using Viterbi algorithm in log space
+        return tag sequence
+        """
+        return self.decode_log(sent)[1]
+
+    def decode_log(self, sent):
+        """
+        exact Viterbi decoding in log space
+        same search and tie-breaking as the Decimal path, but adds float
+        log-probabilities instead of multiplying Decimals, and only
+        enumerates the tags that can emit each word (emission_index)
+        return (log-probability of the best path, tag sequence)
+        """
+        n = len(sent)
+        transitions = self.transitions
+        no_emission = [(v, LOG_ZERO) for v in self.tags]
+        pi = [{('*', '*'): 0.0}]
+        bp = [{}]
+        # S[k + 1] are the candidate tags of position k, S[0] = S[1] = ('*',)
+        S = [('*',), ('*',)]
+        # decode
+        for k in range(1, n + 1):
+            W = S[k - 1]
+            U = S[k]
+            x = self.map_word(sent[k - 1])
+            # only the tags that can emit x, all tags if none can
+            V = self.emission_index.get(x) or no_emission
+            pi_prev = pi[k - 1]
+            pi_k, bp_k = {}, {}
+            for u in U:
+                # pi(k - 1, w, u) and the transitions out of (w, u), looked
+                # up once for all v
+                prev = [(w, pi_prev.get((w, u), LOG_ZERO), transitions.get((w, u), NO_TRANSITIONS))
+                        for w in W]
+                for v, e in V:
+                    max_pi, max_w = None, ''
+                    for w, p, trans in prev:
+                        tmp = p + trans.get(v, LOG_ZERO) + e
+                        if max_pi is None or tmp > max_pi:
+                            max_pi, max_w = tmp, w
+                    pi_k[(u, v)] = max_pi
+                    bp_k[(u, v)] = max_w
+            pi.append(pi_k)
+            bp.append(bp_k)
+            S.append([v for v, e in V])
+        if instrument.ENABLED:
+            instrument.count('viterbi_cells', sum(len(pi_k) for pi_k in pi))
+        # trace back
+        max_pi, max_u, max_v = None, '', ''
+        for u in S[n]:
+            for v in S[n + 1]:
+                tmp = pi[n].get((u, v), LOG_ZERO) \
+                    + transitions.get((u, v), NO_TRANSITIONS).get('STOP', LOG_ZERO)
+                if max_pi is None or tmp > max_pi:
+                    max_pi, max_u, max_v = tmp, u, v
+        result = range(0, n+1)
+        result[n-1], result[n] = max_u, max_v
+        for k in range(n-2, 0, -1):
+            result[k] = bp[k+2].get((result[k+1], result[k+2]), '')
+        if tracing.ENABLED:
+            self.trace_trellis(sent, pi, bp, max_pi, result[1:])
+        return max_pi, result[1:]
+
+    def decode_beam(self, sent):
+        """
+        beam-pruned Viterbi decoding in log space
+        each kept state (w, u) of position k - 1 is extended with the tags
+        v that can emit x_k, then the states (u, v) of position k are
+        pruned by prune_states
+        return (log-probability of the best path found, tag sequence)
+        """
+        n = len(sent)
+        transitions = self.transitions
+        no_emission = [(v, LOG_ZERO) for v in self.tags]
+        pi = [{('*', '*'): 0.0}]
+        bp = [{}]
+        # decode
+        for k in range(1, n + 1):
+            x = self.map_word(sent[k - 1])
+            V = self.emission_index.get(x) or no_emission
+            pi_k, bp_k = {}, {}
+            for (w, u), p in pi[k - 1].iteritems():
+                trans = transitions.get((w, u), NO_TRANSITIONS)
+                for v, e in V:
+                    tmp = p + trans.get(v, LOG_ZERO) + e
+                    if (u, v) not in pi_k or tmp > pi_k[(u, v)]:
+                        pi_k[(u, v)] = tmp
+                        bp_k[(u, v)] = w
+            pi.append(self.prune_states(pi_k))
+            bp.append(bp_k)
+        if instrument.ENABLED:
+            instrument.count('viterbi_cells', sum(len(pi_k) for pi_k in pi))
+        # trace back
+        max_pi, max_u, max_v = None, '', ''
+        for (u, v), p in pi[n].iteritems():
+            tmp = p + transitions.get((u, v), NO_TRANSITIONS).get('STOP', LOG_ZERO)
+            if max_pi is None or tmp > max_pi:
+                max_pi, max_u, max_v = tmp, u, v
+        result = range(0, n+1)
+        result[n-1], result[n] = max_u, max_v
+        for k in range(n-2, 0, -1):
+            result[k] = bp[k+2][(result[k+1], result[k+2])]
+        if tracing.ENABLED:
+            self.trace_trellis(sent, pi, bp, max_pi, result[1:])
+        return max_pi, result[1:]
+
+    def prune_states(self, pi_k):
+        """
+        keep the beam_size best states of pi_k, and/or those within
+        beam_threshold of the best one
+        """
+        states = sorted(pi_k.iteritems(), key=lambda state: state[1], reverse=True)
+        if self.beam_threshold is not None:
+            lowest = states[0][1] - self.beam_threshold
+            states = [state for state in states if state[1] >= lowest]
+        if self.beam_size is not None:
+            states = states[:self.beam_size]
+        return dict(states)
+
+    def search_errors(self, test_data_file):
+        """
+        compare beam decoding against exact decoding on a test file
+        a search error is a sentence whose best beam path has a lower
+        log-probability than the exact best path
+        return (number of sentences, number of search errors,
+                number of sentences tagged differently)
+        """
+        sent_iterator = util.test_sent_iterator(
+            util.test_data_iterator(test_data_file))
+        sents, errors, different = 0, 0, 0
+        for sent in sent_iterator:
+            exact_pi, exact_tags = self.decode_log(sent)
+            beam_pi, beam_tags = self.decode_beam(sent)
+            sents += 1
+            if beam_pi < exact_pi:
+                errors += 1
+            if beam_tags != exact_tags:
+                different += 1
+        return sents, errors, different
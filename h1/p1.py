@@ -1,24 +1,15 @@
 from hmm import SimpleTagger
 import util
+import instrument
 
 
-def train(train_data_filename, rare_train_data_filename, hmm_model_filename):
-    print '1. train hmm model'
-    hmm_model = SimpleTagger(3)
-    hmm_model.train(file(train_data_filename, 'r'))
-
-    print '2. replace rare words'
-    rare_words = hmm_model.rare_words
-    util.process_rare_words(
-        file(train_data_filename),
-        file(rare_train_data_filename, 'w'),
-        rare_words,
-        util.rare_words_rule_p1)
-
-    print '3. train hmm model again using the new train data (with RARE_TAG)'
+def train(train_data_filename, hmm_model_filename):
+    print '1. train hmm model, replacing rare words (with RARE_TAG)'
     hmm_model_rare = SimpleTagger(3)
-    hmm_model_rare.train(file(rare_train_data_filename))
-    hmm_model_rare.write_counts(file(hmm_model_filename, 'w'))
+    hmm_model_rare.rare_words_rule = util.rare_words_rule_p1
+    hmm_model_rare.train_rare(file(train_data_filename, 'r'))
+    with instrument.timer('output'):
+        hmm_model_rare.write_counts(file(hmm_model_filename, 'w'))
 
 
 def tag(test_data_filename, result_filename, hmm_model_filename):
@@ -27,17 +18,18 @@ def tag(test_data_filename, result_filename, hmm_model_filename):
     tagger.read_counts(file(hmm_model_filename))
 
     print '2. tag test file'
-    tagger.tag(test_data_filename, result_filename)
+    with instrument.timer('decode'):
+        tagger.tag(test_data_filename, result_filename)
 
 
 def main():
+    instrument.start()
     TRAIN = False
     # 1. training
     hmm_model_filename = 'p1.model'
     train_data_filename = 'gene.train'
-    rare_train_data_filename = 'p1.gene.train'
     if TRAIN:
-        train(train_data_filename, rare_train_data_filename, hmm_model_filename)
+        train(train_data_filename, hmm_model_filename)
 
     # 2. tagging
     test_data_filename = 'gene.dev'
@@ -1,46 +1,78 @@
 from hmm import ViterbiTagger
+from compiled_hmm import CompiledHmm
+from parallel import tag_parallel
 import util
+import instrument
+import tracing
 
 
 DEBUG = False
 
 
-def train(train_data_filename, rare_train_data_filename, hmm_model_filename, rare_words_rule):
-    print '1. train hmm model'
+def train(train_data_filename, hmm_model_filename, rare_words_rule):
+    print '1. train hmm model, replacing rare words'
+    hmm_model_rare = ViterbiTagger(3)
+    hmm_model_rare.rare_words_rule = rare_words_rule
+    hmm_model_rare.train_rare(file(train_data_filename))
+    with instrument.timer('output'):
+        hmm_model_rare.write_counts(file(hmm_model_filename, 'w'))
+
+
+def tag(test_data_filename, result_filename, hmm_model_filename, processes=1):
+    print '1. load Hmm model'
+    tagger = ViterbiTagger(3, log_space=True)
+    tagger.read_counts(file(hmm_model_filename))
+
+    print '2. tag test file'
+    if processes > 1:
+        tag_parallel(tagger, file(test_data_filename), file(result_filename, 'w'), processes)
+    else:
+        tagger.tag(file(test_data_filename), file(result_filename, 'w'))
+
+
+def compile_model(hmm_model_filename, compiled_model_filename, rare_words_rule):
+    print '1. load Hmm model'
     hmm_model = ViterbiTagger(3)
     hmm_model.rare_words_rule = rare_words_rule
-    hmm_model.train(file(train_data_filename))
+    hmm_model.read_counts(file(hmm_model_filename))
 
-    print '2. process rare words'
-    util.process_rare_words(
-        file(train_data_filename),
-        file(rare_train_data_filename, 'w'),
-        hmm_model.rare_words,
-        hmm_model.rare_words_rule)
+    print '2. write compiled model'
+    with instrument.timer('params'):
+        compiled = CompiledHmm(hmm_model)
+    with instrument.timer('output'):
+        compiled.save(file(compiled_model_filename, 'wb'))
 
-    print '3. train hmm model again using the new train data'
-    hmm_model_rare = ViterbiTagger(3)
-    hmm_model_rare.train(file(rare_train_data_filename))
-    hmm_model_rare.write_counts(file(hmm_model_filename, 'w'))
 
+def tag_compiled(test_data_filename, result_filename, compiled_model_filename, batch_size=64, with_logprob=False):
+    print '1. load compiled Hmm model'
+    with instrument.timer('load'):
+        tagger = CompiledHmm.load(compiled_model_filename)
 
-def tag(test_data_filename, result_filename, hmm_model_filename):
+    print '2. tag test file'
+    tagger.tag(file(test_data_filename), file(result_filename, 'w'), batch_size, with_logprob)
+
+
+def beam_search_errors(test_data_filename, hmm_model_filename, beam_size=None, beam_threshold=None):
     print '1. load Hmm model'
-    tagger = ViterbiTagger(3)
+    tagger = ViterbiTagger(3, log_space=True, beam_size=beam_size, beam_threshold=beam_threshold)
     tagger.read_counts(file(hmm_model_filename))
 
-    print '2. tag test file'
-    tagger.tag(file(test_data_filename), file(result_filename, 'w'))
+    print '2. compare beam and exact decoding'
+    sents, errors, different = tagger.search_errors(file(test_data_filename))
+    print 'beam size: {0}, threshold: {1}'.format(beam_size, beam_threshold)
+    print 'search errors: {0} / {1} sentences ({2:.4f}), tagged differently: {3}'.format(
+        errors, sents, float(errors) / sents, different)
 
 
 def main():
+    instrument.start()
+    tracing.start()
     TRAIN = True
     # 1. training
     hmm_model_filename = 'p2.model'
     train_data_filename = 'gene.train'
-    rare_train_data_filename = 'p2.gene.train'
     if TRAIN:
-        train(train_data_filename, rare_train_data_filename, hmm_model_filename, util.rare_words_rule_p1)
+        train(train_data_filename, hmm_model_filename, util.rare_words_rule_p1)
 
     # 2. tagging
     test_data_filename = 'gene.dev'
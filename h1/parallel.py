@@ -0,0 +1,73 @@
+#! /usr/bin/python
+
+import multiprocessing
+import util
+import instrument
+
+"""
+Tag a test file with a pool of worker processes. The tagger is handed to
+each worker once when the pool starts, sentences are sent in shards and
+the tagged shards are written back in input order.
+"""
+
+SHARD_SIZE = 64  # sentences per task sent to a worker
+
+_tagger = None  # the tagger of a worker process
+
+
+def _init_worker(tagger):
+    global _tagger
+    _tagger = tagger
+
+
+def _tag_shard(shard):
+    """
+    tag a shard of sentences, return the output lines for the shard
+    """
+    lines = []
+    for sent in shard:
+        for s, t in zip(sent, _tagger.viterbi(sent)):
+            lines.append('{0} {1}\n'.format(s, t))
+        lines.append('\n')
+    return ''.join(lines)
+
+
+def shard_iterator(sent_iterator, shard_size):
+    """
+    return an iterator object that yields lists of shard_size sentences
+    """
+    shard = []
+    for sent in sent_iterator:
+        instrument.count('sentences')
+        instrument.count('tokens', len(sent))
+        shard.append(sent)
+        if len(shard) == shard_size:
+            yield shard
+            shard = []
+    if shard:
+        yield shard
+
+
+def tag_parallel(tagger, test_data_file, result_file, processes=None, shard_size=SHARD_SIZE):
+    """
+    tag test_data_file with processes workers (default: number of CPUs),
+    tagger can be any object with a viterbi(sent) method
+    """
+    sent_iterator = util.test_sent_iterator(
+        util.test_data_iterator(test_data_file))
+    pool = multiprocessing.Pool(processes, _init_worker, (tagger,))
+    try:
+        shards = pool.imap(_tag_shard, shard_iterator(sent_iterator, shard_size))
+        while True:
+            with instrument.timer('decode'):
+                output = next(shards, None)
+            if output is None:
+                break
+            with instrument.timer('output'):
+                result_file.write(output)
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
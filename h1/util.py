@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 import sys
 import re
+from collections import OrderedDict
 
 DEBUG = False
 NUMERIC_TAG = '_NUMERIC_'
@@ -8,6 +9,11 @@ ALL_UPPERCASE_TAG = '_ALLUPPERCASE_'
 LAST_UPPERCASE_TAG = '_LASTUPPERCASE_'
 RARE_TAG = '_RARE_'
 RARE_WORD_THRESHOLD = 5
+UNSEEN_WORD_CACHE_SIZE = 10000  # unseen test words whose rare word class is memoized
+
+NUMERIC_PATTERN = re.compile('[0-9]+')
+ALL_UPPERCASE_PATTERN = re.compile('^[A-Z]+$')
+LAST_UPPERCASE_PATTERN = re.compile('.*[A-Z]$')
 
 
 def is_numeric(word):
@@ -15,7 +21,7 @@ def is_numeric(word):
     the word contains at least one numeric characters
     '''
     find_numeric = False
-    if re.match('[0-9]+', word):
+    if NUMERIC_PATTERN.match(word):
         find_numeric = True
     # for c in word:
     #     try:
@@ -32,7 +38,7 @@ def is_all_uppercase(word):
     The word consists entirely of capitalized letters.
     '''
     all_uppercase = False
-    if re.match('^[A-Z]+$', word):
+    if ALL_UPPERCASE_PATTERN.match(word):
         all_uppercase = True
     # for c in word:
     #     if not c.isupper():
@@ -46,7 +52,7 @@ def is_last_uppercase(word):
     The word is rare, not all capitals, and ends with a capital letter.
     '''
     last_uppercase = False
-    if re.match('.*[A-Z]$', word):
+    if LAST_UPPERCASE_PATTERN.match(word):
         last_uppercase = True
     return last_uppercase
     # return word[-1].isupper()
@@ -79,9 +85,40 @@ def rare_words_rule_p3(word):
     return w
 
 
+class LRUCache(object):
+    """
+    bounded mapping, the least recently used key is dropped when it is full
+    """
+    def __init__(self, maxsize=UNSEEN_WORD_CACHE_SIZE):
+        self.maxsize = maxsize
+        self.cache = OrderedDict()
+
+    def get(self, key, default=None):
+        try:
+            value = self.cache.pop(key)
+        except KeyError:
+            return default
+        self.cache[key] = value  # most recently used goes last
+        return value
+
+    def put(self, key, value):
+        if key in self.cache:
+            del self.cache[key]
+        elif len(self.cache) >= self.maxsize:
+            self.cache.popitem(last=False)
+        self.cache[key] = value
+
+    def clear(self):
+        self.cache.clear()
+
+    def __len__(self):
+        return len(self.cache)
+
+
 def process_rare_words(input_file, output_file, rare_words, processer):
     """
     applying the rare word rule to process the training data
+    rare_words should be a set, it is probed for every token
     """
     l = input_file.readline()
     while l:
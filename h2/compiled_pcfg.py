@@ -0,0 +1,339 @@
+#! /usr/bin/python
+# coding=utf-8
+import json
+import numpy as np
+import instrument
+import tracing
+from pcfg import ROOT
+from pcfg import default_tree
+from pcfg import rare_words_rule_p1
+
+"""
+Compiled CKY: nonterminals and words are mapped to integer indexes, the chart
+is an n x n x |N| array of log-probabilities and the back pointers are integer
+arrays, so all spans of a length are filled at once by a few broadcasted
+NumPy operations over their split points and the binary rules.
+"""
+
+LOG_ZERO = float('-inf')
+
+
+class CompiledPCFG(object):
+    """
+    Log-space params of a PCFG in Chomsky normal form
+
+    binary rule r is nonterms[rule_x[r]] -> nonterms[rule_y[r]] nonterms[rule_z[r]]
+    with log probability log_q[r]; rules are sorted by parent, the rules of
+    parents[p] start at rule_starts[p].
+    log_e[w, X] = log q(X -> w), the last row is an all zero-probability
+    row used for words that have no rule at all
+    With max_marginal, CKY returns the max-marginal tree instead of the
+    Viterbi one (see max_marginal_tree).
+    """
+    def __init__(self, pcfg, max_marginal=False):
+        nonterms = sorted(pcfg.nonterm)
+        words = sorted(pcfg.word)
+        nonterm_index = dict((X, i) for i, X in enumerate(nonterms))
+        word_index = dict((w, i) for i, w in enumerate(words))
+
+        rules = sorted((nonterm_index[X], nonterm_index[Y], nonterm_index[Z], np.log(p))
+                       for (X, Y, Z), p in pcfg.q_x_y1y2.iteritems() if p > 0.0)
+        rule_x, rule_y, rule_z, log_q = [np.array(a) for a in zip(*rules)]
+
+        log_e = np.full((len(words) + 1, len(nonterms)), LOG_ZERO)
+        for (X, w), p in pcfg.q_x_w.iteritems():
+            if p > 0.0:
+                log_e[word_index[w], nonterm_index[X]] = np.log(p)
+
+        self.nonterms = nonterms
+        self.nonterm_index = nonterm_index
+        self.root = nonterm_index.get(ROOT)
+        self.words = words
+        self.word_index = word_index
+        self.rare_words_rule = getattr(pcfg, 'rare_words_rule', rare_words_rule_p1)
+        self.rule_x = rule_x.astype(np.intp)
+        self.rule_y = rule_y.astype(np.intp)
+        self.rule_z = rule_z.astype(np.intp)
+        self.log_q = log_q.astype(np.float64)
+        self.log_e = log_e
+        self.parents, self.rule_starts = np.unique(self.rule_x, return_index=True)
+        # position in parents of the parent of each rule
+        self.rule_parent = np.searchsorted(self.parents, self.rule_x)
+        # the rules grouped by left child and by right child, for the
+        # outside pass of inside_outside
+        self.q = np.exp(self.log_q)
+        left_order = np.argsort(self.rule_y, kind='mergesort')
+        self.left_children, self.left_starts = np.unique(self.rule_y[left_order], return_index=True)
+        self.left_rule_x = self.rule_x[left_order]
+        self.left_rule_z = self.rule_z[left_order]
+        self.left_q = self.q[left_order]
+        right_order = np.argsort(self.rule_z, kind='mergesort')
+        self.right_children, self.right_starts = np.unique(self.rule_z[right_order], return_index=True)
+        self.right_rule_x = self.rule_x[right_order]
+        self.right_rule_y = self.rule_y[right_order]
+        self.right_q = self.q[right_order]
+        self.max_marginal = max_marginal
+
+    def word_rows(self, words):
+        """
+        rows of log_e for the words of a sentence, words not in the model
+        use the row of their rare word class
+        """
+        rows = []
+        for w in words:
+            row = self.word_index.get(w)
+            if row is None:
+                row = self.word_index.get(self.rare_words_rule(w), len(self.word_index))
+            rows.append(row)
+        return np.array(rows, dtype=np.intp)
+
+    def tag(self, input, output):
+        for line in input:
+            instrument.count('sentences')
+            instrument.count('tokens', len(line.split()))
+            with instrument.timer('decode'):
+                result = self.CKY(line)
+            with instrument.timer('output'):
+                output.write(json.dumps(result))
+                output.write('\n')
+
+    def CKY(self, sentence):
+        """
+        parse a sentence, return the best tree; a sentence without any
+        parse gets pcfg.default_tree
+        """
+        words = sentence.strip().split(' ')
+        rows = self.word_rows(words)
+        n = len(words)
+        if self.max_marginal:
+            result = self.max_marginal_tree(words, rows)
+            if result is not None:
+                return result
+        pi, bp_rule, bp_split = self.viterbi_chart(rows)
+        X = self.root
+        if X is None or pi[0, n - 1, X] == LOG_ZERO:
+            X = int(pi[0, n - 1].argmax())
+        instrument.count('cky_cells', n * (n + 1) // 2 * len(self.nonterms))
+        if pi[0, n - 1, X] == LOG_ZERO:
+            # no parse: each word gets its best preterminal (ROOT if it has none)
+            diagonal = np.arange(n)
+            leaves = pi[diagonal, diagonal]
+            tags = [self.nonterms[tag] if leaf[tag] > LOG_ZERO else ROOT
+                    for tag, leaf in zip(leaves.argmax(axis=1), leaves)]
+            result = default_tree(words, tags)
+        else:
+            result = self.traceback(words, bp_rule, bp_split, 0, n - 1, X)
+        if tracing.ENABLED:
+            self.trace_chart(words, pi, bp_rule, bp_split, result)
+        return result
+
+    def viterbi_chart(self, rows):
+        """
+        CKY chart of a sentence given the log_e rows of its words
+        pi[i, j, X] is the best log-probability of X spanning words i..j
+        (0-based, inclusive); its best rule is bp_rule[i, j, X] and its left
+        child spans i..bp_split[i, j, X]. Ties are broken towards the first
+        rule and the first split point.
+        return (pi, bp_rule, bp_split)
+        """
+        n = len(rows)
+        N = len(self.nonterms)
+        R = len(self.log_q)
+        pi = np.full((n, n, N), LOG_ZERO)
+        bp_rule = np.zeros((n, n, N), dtype=np.int32)
+        bp_split = np.zeros((n, n, N), dtype=np.int32)
+        diagonal = np.arange(n)
+        pi[diagonal, diagonal] = self.log_e[rows]
+        rule_ids = np.arange(R)
+        for l in xrange(2, n + 1):
+            i = np.arange(n - l + 1)[:, np.newaxis]  # span starts
+            j = i + l - 1  # span ends
+            s = i + np.arange(l - 1)  # split points, the left child ends at s
+            # scores[span, split, r] = log q(r) + pi(i, s, Y) + pi(s + 1, j, Z)
+            scores = pi[i, s][:, :, self.rule_y] + pi[s + 1, j][:, :, self.rule_z] + self.log_q
+            split = scores.argmax(axis=1)
+            best = scores.max(axis=1)
+            parent_best = np.maximum.reduceat(best, self.rule_starts, axis=1)
+            # the first rule of each parent reaching the parent's best score
+            winners = np.where(best == parent_best[:, self.rule_parent], rule_ids, R)
+            rule = np.minimum.reduceat(winners, self.rule_starts, axis=1)
+            X = self.parents[np.newaxis, :]
+            pi[i, j, X] = parent_best
+            bp_rule[i, j, X] = rule
+            bp_split[i, j, X] = i + split[i, rule]
+        return pi, bp_rule, bp_split
+
+    def inside_outside(self, rows):
+        """
+        inside and outside log-probabilities of a sentence given the log_e
+        rows of its words
+        beta[i, j, X]: log p(words i..j | X spans them)
+        alpha[i, j, X]: log p(words outside i..j, X spans i..j | ROOT)
+        (0-based, inclusive spans)
+        Sums are taken on probabilities scaled by the best entry of each
+        cell (see scaled); the rules are summed by parent, left child or
+        right child with add.reduceat over the rules sorted that way.
+        return (log p(sentence), -inf if it has no parse, beta, alpha)
+        """
+        n = len(rows)
+        N = len(self.nonterms)
+        # inside probabilities, each cell scaled by its best entry:
+        # beta = log(inside) + inside_scale
+        inside = np.zeros((n, n, N))
+        inside_scale = np.zeros((n, n))
+        diagonal = np.arange(n)
+        inside[diagonal, diagonal], inside_scale[diagonal, diagonal] = scaled(self.log_e[rows])
+        for l in xrange(2, n + 1):
+            i = np.arange(n - l + 1)[:, np.newaxis]
+            j = i + l - 1
+            s = i + np.arange(l - 1)
+            scale = inside_scale[i, s] + inside_scale[s + 1, j]
+            span_scale = scale.max(axis=1)
+            # inside of each rule summed over the split points, times q(r)
+            rules = np.einsum('ks,ksr->kr', np.exp(scale - span_scale[:, np.newaxis]),
+                              inside[i, s][:, :, self.rule_y] * inside[s + 1, j][:, :, self.rule_z]) * self.q
+            cell = np.zeros((n - l + 1, N))
+            cell[:, self.parents] = np.add.reduceat(rules, self.rule_starts, axis=1)
+            best = cell.max(axis=1)
+            best[best == 0.0] = 1.0
+            inside[i[:, 0], j[:, 0]] = cell / best[:, np.newaxis]
+            inside_scale[i[:, 0], j[:, 0]] = span_scale + np.log(best)
+        with np.errstate(divide='ignore'):
+            beta = np.log(inside) + inside_scale[:, :, np.newaxis]
+
+        alpha = np.full((n, n, N), LOG_ZERO)
+        log_z = LOG_ZERO if self.root is None else beta[0, n - 1, self.root]
+        if log_z == LOG_ZERO:
+            return log_z, beta, alpha
+        alpha[0, n - 1, self.root] = 0.0
+        # parents before their children: a span only gets outside mass from longer spans
+        for l in xrange(n, 1, -1):
+            i = np.arange(n - l + 1)[:, np.newaxis]
+            j = i + l - 1
+            s = i + np.arange(l - 1)
+            parent, parent_scale = scaled(alpha[i[:, 0], j[:, 0]])
+            left, right = inside[i, s], inside[s + 1, j]
+            parent_scale = parent_scale[:, np.newaxis, np.newaxis]
+            with np.errstate(divide='ignore'):
+                # left child (i, s) of each rule gets alpha(X) q(r) beta(s + 1, j, Z)
+                to_left = np.full(left.shape, LOG_ZERO)
+                to_left[:, :, self.left_children] = np.log(np.add.reduceat(
+                    (parent[:, self.left_rule_x] * self.left_q)[:, np.newaxis, :] * right[:, :, self.left_rule_z],
+                    self.left_starts, axis=2))
+                alpha[i, s] = np.logaddexp(alpha[i, s],
+                                           to_left + parent_scale + inside_scale[s + 1, j][:, :, np.newaxis])
+                # right child (s + 1, j) gets alpha(X) q(r) beta(i, s, Y)
+                to_right = np.full(right.shape, LOG_ZERO)
+                to_right[:, :, self.right_children] = np.log(np.add.reduceat(
+                    (parent[:, self.right_rule_x] * self.right_q)[:, np.newaxis, :] * left[:, :, self.right_rule_y],
+                    self.right_starts, axis=2))
+                alpha[s + 1, j] = np.logaddexp(alpha[s + 1, j],
+                                               to_right + parent_scale + inside_scale[i, s][:, :, np.newaxis])
+        return log_z, beta, alpha
+
+    def expected_counts(self, sentences):
+        """
+        expected rule counts of sentences (lists of words) under the model
+        return (sum of log p(sentence), number of sentences with a parse,
+                expected count of each binary rule,
+                expected count of X -> w: a log_e shaped array)
+        """
+        log_likelihood, parsed = 0.0, 0
+        binary = np.zeros(len(self.log_q))
+        unary = np.zeros(self.log_e.shape)
+        for words in sentences:
+            rows = self.word_rows(words)
+            log_z, beta, alpha = self.inside_outside(rows)
+            if log_z == LOG_ZERO:
+                continue
+            log_likelihood += log_z
+            parsed += 1
+            n = len(rows)
+            diagonal = np.arange(n)
+            # p(X -> w_i used | sentence) = alpha(i, i, X) beta(i, i, X) / p(sentence)
+            np.add.at(unary, rows, np.exp(alpha[diagonal, diagonal] + beta[diagonal, diagonal] - log_z))
+            for l in xrange(2, n + 1):
+                i = np.arange(n - l + 1)[:, np.newaxis]
+                j = i + l - 1
+                s = i + np.arange(l - 1)
+                # p(r used at (i, s, j) | sentence)
+                #   = alpha(i, j, X) q(r) beta(i, s, Y) beta(s + 1, j, Z) / p(sentence)
+                mu = alpha[i, j][:, :, self.rule_x] + self.log_q \
+                    + beta[i, s][:, :, self.rule_y] + beta[s + 1, j][:, :, self.rule_z] - log_z
+                binary += np.exp(mu).sum(axis=(0, 1))
+        return log_likelihood, parsed, binary, unary
+
+    def max_marginal_tree(self, words, rows):
+        """
+        the tree maximizing the expected number of correct labelled spans,
+        i.e. the sum of the posteriors p(X spans i..j | sentence) of its
+        nodes (Goodman's labelled recall parse), from the inside and
+        outside charts. Each span takes its most probable label, so the
+        tree may use rules the grammar does not have.
+        return None if the sentence has no ROOT parse
+        """
+        log_z, beta, alpha = self.inside_outside(rows)
+        if log_z == LOG_ZERO:
+            return None
+        n = len(rows)
+        posterior = np.exp(alpha + beta - log_z)
+        label = posterior.argmax(axis=2)
+        # score[i, j]: best expected number of correct spans of a subtree over i..j
+        score = posterior.max(axis=2)
+        split = np.zeros((n, n), dtype=np.int32)
+        for l in xrange(2, n + 1):
+            i = np.arange(n - l + 1)[:, np.newaxis]
+            j = i + l - 1
+            s = i + np.arange(l - 1)
+            totals = score[i, s] + score[s + 1, j]
+            i, j = i[:, 0], j[:, 0]
+            score[i, j] += totals.max(axis=1)
+            split[i, j] = i + totals.argmax(axis=1)
+        instrument.count('cky_cells', n * (n + 1) // 2 * len(self.nonterms))
+        result = self.span_traceback(words, label, split, 0, n - 1)
+        if tracing.ENABLED:
+            tracing.event('sentence', words=words, n=n, nonterminals=len(self.nonterms), tree=result,
+                          expected_recall=float(score[0, n - 1]))
+        return result
+
+    def span_traceback(self, words, label, split, i, j):
+        if i == j:
+            return [self.nonterms[label[i, i]], words[i]]
+        s = split[i, j]
+        return [self.nonterms[label[i, j]],
+                self.span_traceback(words, label, split, i, s),
+                self.span_traceback(words, label, split, s + 1, j)]
+
+    def traceback(self, words, bp_rule, bp_split, i, j, X):
+        if i == j:
+            return [self.nonterms[X], words[i]]
+        r = bp_rule[i, j, X]
+        s = bp_split[i, j, X]
+        return [self.nonterms[X],
+                self.traceback(words, bp_rule, bp_split, i, s, self.rule_y[r]),
+                self.traceback(words, bp_rule, bp_split, s + 1, j, self.rule_z[r])]
+
+    def trace_chart(self, words, pi, bp_rule, bp_split, tree):
+        """
+        record a parsed sentence as trace events, as CKYTagger.trace_chart
+        (1-based spans, log-probabilities)
+        """
+        for i, j, X in zip(*np.nonzero(pi > LOG_ZERO)):
+            bp = None
+            if i != j:
+                r = bp_rule[i, j, X]
+                bp = (self.nonterms[self.rule_y[r]], self.nonterms[self.rule_z[r]], int(bp_split[i, j, X]) + 1)
+            tracing.event('cell', i=int(i) + 1, j=int(j) + 1, X=self.nonterms[X], pi=float(pi[i, j, X]), bp=bp)
+        tracing.event('sentence', words=words, n=len(words), nonterminals=len(self.nonterms), tree=tree)
+
+
+def scaled(log_chart):
+    """
+    probabilities of the cells (last axis) of a log-probability chart, each
+    divided by its best entry
+    return (scaled probabilities, log of the best entry of each cell, 0 for
+            an empty cell)
+    """
+    scale = log_chart.max(axis=-1)
+    scale[~np.isfinite(scale)] = 0.0
+    return np.exp(log_chart - scale[..., np.newaxis]), scale
@@ -0,0 +1,98 @@
+#! /usr/bin/python
+# coding=utf-8
+import multiprocessing
+import numpy as np
+import instrument
+from compiled_pcfg import CompiledPCFG
+
+"""
+EM re-estimation of the rule params of a PCFG on raw sentences. The E-step
+runs inside-outside on the compiled chart (CompiledPCFG.expected_counts),
+split into shards of sentences over a pool of worker processes; the M-step
+is PCFG.cal_rule_params on the expected counts.
+"""
+
+SHARD_SIZE = 20  # sentences per task sent to a worker
+
+_model = None  # the CompiledPCFG of a worker process
+
+
+def _init_worker(model):
+    global _model
+    _model = model
+
+
+def _expected_counts(sentences):
+    return _model.expected_counts(sentences)
+
+
+def expected_counts(model, sentences, processes=1, shard_size=SHARD_SIZE):
+    """
+    CompiledPCFG.expected_counts of sentences, summed over shards parsed by
+    processes workers; processes=1 (the default) runs in this process,
+    processes=None uses one worker per CPU
+    """
+    if processes == 1:
+        return model.expected_counts(sentences)
+    # longest first, so the slowest shards do not start last
+    sentences = sorted(sentences, key=len, reverse=True)
+    shards = [sentences[k:k + shard_size] for k in xrange(0, len(sentences), shard_size)]
+    log_likelihood, parsed = 0.0, 0
+    binary = np.zeros(len(model.log_q))
+    unary = np.zeros(model.log_e.shape)
+    pool = multiprocessing.Pool(processes, _init_worker, (model,))
+    try:
+        for shard in pool.imap_unordered(_expected_counts, shards):
+            log_likelihood += shard[0]
+            parsed += shard[1]
+            binary += shard[2]
+            unary += shard[3]
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+    return log_likelihood, parsed, binary, unary
+
+
+def em(pcfg, sentences, iterations=5, treebank_weight=1.0, processes=1):
+    """
+    re-estimate q(X->Y1Y2) and q(X->w) of a trained pcfg on sentences
+    (lists of words), starting from its current params
+    each M-step sets the counts of pcfg to treebank_weight times its
+    treebank counts plus the expected counts of the sentences and
+    recomputes its params; treebank_weight=0 is plain EM on the sentences
+    (then words that do not occur in them lose their rules)
+    sentences without a parse are skipped
+    return the log-likelihood of the sentences at each iteration
+    """
+    treebank_unary = pcfg.unary
+    treebank_binary = pcfg.binary
+    log_likelihoods = []
+    for iteration in xrange(iterations):
+        with instrument.timer('params'):
+            model = CompiledPCFG(pcfg)
+        with instrument.timer('em_e_step'):
+            log_likelihood, parsed, binary, unary = expected_counts(model, sentences, processes)
+        instrument.count('em_iterations')
+        instrument.count('em_sentences', len(sentences))
+        print 'iteration {0}: log-likelihood {1:.4f}, parsed {2} / {3} sentences'.format(
+            iteration + 1, log_likelihood, parsed, len(sentences))
+        log_likelihoods.append(log_likelihood)
+
+        with instrument.timer('em_m_step'):
+            binary_counts = dict((key, treebank_weight * count) for key, count in treebank_binary.iteritems())
+            for r in np.flatnonzero(binary):
+                key = (model.nonterms[model.rule_x[r]], model.nonterms[model.rule_y[r]],
+                       model.nonterms[model.rule_z[r]])
+                binary_counts[key] = binary_counts.get(key, 0.0) + binary[r]
+            unary_counts = dict((key, treebank_weight * count) for key, count in treebank_unary.iteritems())
+            # the last row of log_e is for words without any rule
+            for w, X in zip(*np.nonzero(unary[:-1])):
+                key = (model.nonterms[X], model.words[w])
+                unary_counts[key] = unary_counts.get(key, 0.0) + unary[w, X]
+            pcfg.set_counts(
+                dict((key, count) for key, count in unary_counts.iteritems() if count > 0.0),
+                dict((key, count) for key, count in binary_counts.iteritems() if count > 0.0))
+    return log_likelihoods
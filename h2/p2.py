@@ -1,6 +1,13 @@
 import json
+import time
+import instrument
+import tracing
 from pcfg import PCFG
 from pcfg import CKYTagger
+from compiled_pcfg import CompiledPCFG
+from em import em
+from eval_parser import ParseEvaluator
+from parallel import tag_parallel
 from pcfg import process_rare_words
 from pcfg import rare_words_rule_p1
 
@@ -8,38 +15,105 @@ from pcfg import rare_words_rule_p1
 def train(train_data_filename, train_rare_filename, pcfg_model_filename, rare_words_rule):
     print 'train PCFG model'
     pcfg = PCFG()
-    for l in open(train_data_filename):
-        t = json.loads(l)
-        pcfg.count(t)
-    pcfg.count_word()
+    with instrument.timer('count'):
+        for l in open(train_data_filename):
+            t = json.loads(l)
+            pcfg.count(t)
 
     print 'process rare word'
-    process_rare_words(open(train_data_filename),
-        open(train_rare_filename, 'w'),
-        pcfg.rare_words,
-        rare_words_rule)
+    with instrument.timer('rare_words'):
+        pcfg.count_word()
+        process_rare_words(open(train_data_filename),
+            open(train_rare_filename, 'w'),
+            pcfg.rare_words,
+            rare_words_rule)
 
     print 'train PCFG model again'
     new_pcfg = PCFG()
-    for l in open(train_rare_filename):
-        t = json.loads(l)
-        new_pcfg.count(t)
-    new_pcfg.cal_rule_params()
+    with instrument.timer('count'):
+        for l in open(train_rare_filename):
+            t = json.loads(l)
+            new_pcfg.count(t)
+    with instrument.timer('params'):
+        new_pcfg.cal_rule_params()
 
-    new_pcfg.write(open(pcfg_model_filename, 'w'))
+    with instrument.timer('output'):
+        new_pcfg.write(open(pcfg_model_filename, 'w'))
     return new_pcfg
 
 
-def tag(test_data_filename, result_filename, pcfg_model_filename):
+def train_em(raw_data_filename, pcfg_model_filename, em_model_filename,
+             iterations=5, treebank_weight=1.0, processes=1):
+    print 'load PCFG model'
+    pcfg = PCFG()
+    pcfg.read(open(pcfg_model_filename))
+    sentences = [l.strip().split(' ') for l in open(raw_data_filename) if l.strip()]
+
+    print 'EM on {0} sentences'.format(len(sentences))
+    em(pcfg, sentences, iterations, treebank_weight, processes)
+
+    with instrument.timer('output'):
+        pcfg.write(open(em_model_filename, 'w'))
+    return pcfg
+
+
+def tag(test_data_filename, result_filename, pcfg_model_filename, processes=1):
     print 'load PCFG model'
     tagger = CKYTagger()
     tagger.read(open(pcfg_model_filename))
     # tagger.write_params(open('param', 'w'))
-    tagger.tag(open(test_data_filename), open(result_filename, 'w'))
-    pass
+    if processes > 1:
+        tag_parallel(tagger, open(test_data_filename), open(result_filename, 'w'), processes)
+    else:
+        tagger.tag(open(test_data_filename), open(result_filename, 'w'))
+
+
+def tag_compiled(test_data_filename, result_filename, pcfg_model_filename, processes=1, max_marginal=False):
+    print 'load PCFG model'
+    pcfg = CKYTagger()
+    pcfg.read(open(pcfg_model_filename))
+    with instrument.timer('params'):
+        tagger = CompiledPCFG(pcfg, max_marginal)
+    if processes > 1:
+        tag_parallel(tagger, open(test_data_filename), open(result_filename, 'w'), processes)
+    else:
+        tagger.tag(open(test_data_filename), open(result_filename, 'w'))
+
+
+def pruning_report(test_data_filename, key_filename, pcfg_model_filename,
+                   beam_size=None, beam_threshold=None, figure_of_merit=False):
+    print 'load PCFG model'
+    exact = CKYTagger()
+    exact.read(open(pcfg_model_filename))
+    pruned = CKYTagger(beam_size, beam_threshold, figure_of_merit)
+    pruned.read(open(pcfg_model_filename))
+
+    print 'parse exactly and with pruning'
+    sentences = open(test_data_filename).readlines()
+    key_trees = [json.loads(l) for l in open(key_filename)]
+    results = []
+    for tagger in (exact, pruned):
+        start = time.time()
+        trees = [tagger.CKY(sentence) for sentence in sentences]
+        seconds = time.time() - start
+        fscore = ParseEvaluator().compute_fscore(key_trees, trees)
+        results.append((trees, seconds, fscore.fscore()))
+
+    (exact_trees, exact_seconds, exact_f1), (pruned_trees, pruned_seconds, pruned_f1) = results
+    print 'beam size: {0}, threshold: {1}, figure of merit: {2}'.format(beam_size, beam_threshold, figure_of_merit)
+    kept = pruned.chart_cells - pruned.pruned_cells
+    print 'chart entries: {0} exact; with pruning {1} built, {2} pruned, {3} kept ({4:.1%} of the exact chart skipped)'.format(
+        exact.chart_cells, pruned.chart_cells, pruned.pruned_cells, kept,
+        1.0 - float(kept) / exact.chart_cells)
+    print 'parsed again exactly: {0} sentences'.format(pruned.reparses)
+    print 'seconds: {0:.3f} exact, {1:.3f} pruned'.format(exact_seconds, pruned_seconds)
+    print 'F1: {0:.4f} exact, {1:.4f} pruned, parsed differently: {2} / {3} sentences'.format(
+        exact_f1, pruned_f1, sum(1 for a, b in zip(exact_trees, pruned_trees) if a != b), len(sentences))
 
 
 def main():
+    instrument.start()
+    tracing.start()
     TRAIN = False
     train_data_filename = 'parse_train.dat'
     train_rare_filename = 'p2.train.rare.dat'
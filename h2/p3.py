@@ -1,9 +1,13 @@
+import instrument
+import tracing
 from p2 import train
 from p2 import tag
 from pcfg import rare_words_rule_p1
 
 
 def main():
+    instrument.start()
+    tracing.start()
     TRAIN = True
     train_data_filename = 'parse_train_vert.dat'
     train_rare_filename = 'p3.train.rare.dat'
@@ -0,0 +1,61 @@
+#! /usr/bin/python
+# coding=utf-8
+import json
+import multiprocessing
+import instrument
+
+"""
+Parse a sentence file with a pool of worker processes. The parser is handed
+to each worker once when the pool starts; sentences are sent longest first,
+so the slowest ones do not start last, and the trees are written back in
+input order.
+"""
+
+CHUNK_SIZE = 4  # sentences per task sent to a worker
+
+_tagger = None  # the parser of a worker process
+
+
+def _init_worker(tagger):
+    global _tagger
+    _tagger = tagger
+
+
+def _parse(task):
+    """
+    parse a sentence, return (its line number, the output line)
+    """
+    index, sentence = task
+    return index, json.dumps(_tagger.CKY(sentence)) + '\n'
+
+
+def tag_parallel(tagger, input, output, processes=None, chunksize=CHUNK_SIZE):
+    """
+    parse the sentences of input with processes workers (default: number
+    of CPUs), tagger can be any object with a CKY(sentence) method
+    """
+    sentences = input.readlines()
+    instrument.count('sentences', len(sentences))
+    instrument.count('tokens', sum(len(sentence.split()) for sentence in sentences))
+    # longest first
+    tasks = sorted(enumerate(sentences), key=lambda task: len(task[1].split()), reverse=True)
+    pending = {}  # line number -> output line, parsed but not written yet
+    next_index = 0
+    pool = multiprocessing.Pool(processes, _init_worker, (tagger,))
+    try:
+        parsed = pool.imap_unordered(_parse, tasks, chunksize)
+        while next_index < len(sentences):
+            with instrument.timer('decode'):
+                while next_index not in pending:
+                    index, line = next(parsed)
+                    pending[index] = line
+            with instrument.timer('output'):
+                while next_index in pending:
+                    output.write(pending.pop(next_index))
+                    next_index += 1
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
@@ -1,23 +1,36 @@
 #! /usr/bin/python
 # coding=utf-8
 import json
+import instrument
+import tracing
 from count_cfg_freq import Counts
+import math
 from collections import defaultdict
-from decimal import Decimal
 
 __author__ = 'ping.zou'
 __date__ = '30 Mar 2013'
 
-DEBUG = True
 RARE_TAG = '_RARE_'
 RARE_WORD_THRESHOLD = 5
 ROOT = 'SBARQ'
+LOG_ZERO = float('-inf')
 
 
 def rare_words_rule_p1(word):
     return RARE_TAG
 
 
+def default_tree(words, tags):
+    """
+    right-branching tree over words with preterminals tags and every other
+    node labelled ROOT: the parse of a sentence the grammar cannot derive
+    """
+    tree = [tags[-1], words[-1]]
+    for word, tag in reversed(zip(words[:-1], tags[:-1])):
+        tree = [ROOT, [tag, word], tree]
+    return tree
+
+
 def process_rare_words(input_file, output_file, rare_words, processer):
     """
     替换低频词，并输出到文件
@@ -54,11 +67,6 @@ def replace(tree, rare_words, processer):
             tree[1] = processer(tree[1])
 
 
-def log(msg):
-    if DEBUG:
-        print msg
-
-
 class PCFG(Counts):
     """
     Store counts, and model params
@@ -68,9 +76,12 @@ class PCFG(Counts):
         super(PCFG, self).__init__()
 
         self.word = defaultdict(int)
-        self.rare_words = []
+        self.rare_words = set()
         self.q_x_y1y2 = defaultdict(float)
         self.q_x_w = defaultdict(float)
+        self.rules_by_left = {}  # Y -> Z -> [(X, log q(X->YZ))]
+        self.lexicon = {}  # w -> [(X, log q(X->w))]
+        self.log_prior = {}  # X -> log p(X), the share of X in all nonterminal counts
 
     def count_word(self):
         '''
@@ -82,7 +93,7 @@ class PCFG(Counts):
         # find rare word
         for word, count in self.word.iteritems():
             if count < RARE_WORD_THRESHOLD:
-                self.rare_words.append(word)
+                self.rare_words.add(word)
 
     def cal_rule_params(self):
         """
@@ -96,6 +107,49 @@ class PCFG(Counts):
         for (x, w), count in self.unary.iteritems():
             key = (x, w)
             self.q_x_w[key] = float(count) / float(self.nonterm[x])
+        self.build_grammar_index()
+        self.build_lexicon()
+        # p(X) = Count(X) / sum of Count(X)
+        total = float(sum(self.nonterm.itervalues()))
+        self.log_prior = dict((x, math.log(count / total)) for x, count in self.nonterm.iteritems())
+
+    def set_counts(self, unary, binary):
+        """
+        replace the rule counts (e.g. by expected counts from em.py), count
+        the nonterminals from them and recompute the params
+        """
+        self.unary = unary
+        self.binary = binary
+        self.nonterm = defaultdict(float)
+        for (x, w), count in unary.iteritems():
+            self.nonterm[x] += count
+        for (x, y1, y2), count in binary.iteritems():
+            self.nonterm[x] += count
+        self.nonterm = dict(self.nonterm)
+        self.q_x_y1y2 = defaultdict(float)
+        self.q_x_w = defaultdict(float)
+        self.cal_rule_params()
+
+    def build_lexicon(self):
+        """
+        index the unary rules by word with their log-probabilities: the
+        chart entries of a word
+        """
+        self.lexicon = {}
+        for (x, w), param in self.q_x_w.iteritems():
+            if param > 0.0:
+                self.lexicon.setdefault(w, []).append((x, math.log(param)))
+
+    def build_grammar_index(self):
+        """
+        index the binary rules by left child Y, then right child Z, with
+        their log-probabilities, so CKY only visits the rules whose children
+        are in the chart
+        """
+        self.rules_by_left = {}
+        for (x, y1, y2), param in self.q_x_y1y2.iteritems():
+            if param > 0.0:
+                self.rules_by_left.setdefault(y1, {}).setdefault(y2, []).append((x, math.log(param)))
 
     def write(self, output):
         for sym, count in self.nonterm.iteritems():
@@ -115,31 +169,33 @@ class PCFG(Counts):
         self.binary = {}
         self.nonterm = {}
         self.word = defaultdict(int)
-        self.rare_words = []
+        self.rare_words = set()
         self.q_x_y1y2 = defaultdict(float)
         self.q_x_w = defaultdict(float)
 
-        for line in input:
-            parts = line.strip().split(' ')
-            count = float(parts[0])
-            if parts[1] == 'NONTERMINAL':
-                sym = parts[2]
-                self.nonterm.setdefault(sym, 0)
-                self.nonterm[sym] = count
-            elif parts[1] == 'UNARYRULE':
-                sym = parts[2]
-                word = parts[3]
-                self.unary.setdefault((sym, word), 0)
-                self.unary[(sym, word)] = count
-            elif parts[1] == 'BINARYRULE':
-                sym = parts[2]
-                y1 = parts[3]
-                y2 = parts[4]
-                key = (sym, y1, y2)
-                self.binary.setdefault(key, 0)
-                self.binary[key] = count
-        self.count_word()
-        self.cal_rule_params()
+        with instrument.timer('load'):
+            for line in input:
+                parts = line.strip().split(' ')
+                count = float(parts[0])
+                if parts[1] == 'NONTERMINAL':
+                    sym = parts[2]
+                    self.nonterm.setdefault(sym, 0)
+                    self.nonterm[sym] = count
+                elif parts[1] == 'UNARYRULE':
+                    sym = parts[2]
+                    word = parts[3]
+                    self.unary.setdefault((sym, word), 0)
+                    self.unary[(sym, word)] = count
+                elif parts[1] == 'BINARYRULE':
+                    sym = parts[2]
+                    y1 = parts[3]
+                    y2 = parts[4]
+                    key = (sym, y1, y2)
+                    self.binary.setdefault(key, 0)
+                    self.binary[key] = count
+        with instrument.timer('params'):
+            self.count_word()
+            self.cal_rule_params()
 
     def write_params(self, output_file):
         for (x, y1, y2), param in self.q_x_y1y2.iteritems():
@@ -150,83 +206,152 @@ class PCFG(Counts):
 
 
 class CKYTagger(PCFG):
-    def __init__(self):
+    """
+    CKY parser, exact by default.
+    Setting beam_size and/or beam_threshold prunes each chart cell but the
+    whole-sentence one: only its beam_size best nonterminals, and/or those
+    within beam_threshold (log-probability) of the best one, are kept.
+    With figure_of_merit, nonterminals are ranked by inside log-probability
+    plus log p(X), a crude estimate of their outside probability.
+    chart_cells and pruned_cells count the chart entries built and pruned,
+    reparses the sentences parsed again exactly since pruning left them
+    without a ROOT parse.
+    """
+    def __init__(self, beam_size=None, beam_threshold=None, figure_of_merit=False):
         super(CKYTagger, self).__init__()
         self.rare_words_rule = rare_words_rule_p1
+        self.beam_size = beam_size
+        self.beam_threshold = beam_threshold
+        self.figure_of_merit = figure_of_merit
+        self.chart_cells = 0
+        self.pruned_cells = 0
+        self.reparses = 0
 
     def tag(self, input, output):
         for line in input:
-            result = self.CKY(line)
-            output.write(json.dumps(result))
-            output.write('\n')
-            pass
-
-    def CKY(self, sentence):
-        pi = defaultdict()
-        bp = defaultdict()
-        N = self.nonterm.keys()
+            instrument.count('sentences')
+            instrument.count('tokens', len(line.split()))
+            with instrument.timer('decode'):
+                result = self.CKY(line)
+            with instrument.timer('output'):
+                output.write(json.dumps(result))
+                output.write('\n')
+
+    def CKY(self, sentence, exact=False):
+        """
+        parse a sentence in log space
+        pi[(i, j)] maps each X that can span words i..j (1-based, inclusive)
+        to its best log-probability, bp[(i, j)] maps it to (Y, Z, s)
+        exact turns pruning off; a sentence left without a ROOT parse by
+        pruning is parsed again exactly
+        a sentence without any parse gets default_tree
+        """
+        pi = {}
+        bp = {}
+        prune = not exact and (self.beam_size is not None or self.beam_threshold is not None)
 
         words = sentence.strip().split(' ')
         n = len(words)
 
         # process rare word,测试文件中的未登录词按照相同的规则预处理
+        lexicon = self.lexicon
         for i in xrange(0, n):
-            if words[i] not in self.word.keys():
+            if words[i] not in lexicon:
                 words[i] = self.rare_words_rule(words[i])
 
-        log('Sentence to process: {sent}'.format(sent=' '.join(words)))
-        log('n = {n}, len(N) = {ln}'.format(n=n, ln=len(N)))
-
-        # reduce X, Y and Z searching space,剪枝策略，过滤掉那些不合法的rule
-        SET_X = defaultdict()
-        for (X, Y, Z) in self.binary.keys():
-            if X in SET_X:
-                SET_X[X].append((Y, Z))
-            else:
-                SET_X[X] = []
-
         # init, unary rule
         for i in xrange(1, n + 1):
-            w = words[i - 1]
-            for X in N:
-                if (X, w) in self.unary.keys():
-                    pi[(i, i, X)] = Decimal(self.q_x_w[(X, w)])
-                else:
-                    pi[(i, i, X)] = Decimal(0.0)
-
-        # dp
+            pi[(i, i)] = dict(lexicon.get(words[i - 1], ()))
+            self.chart_cells += len(pi[(i, i)])
+            if prune and n > 1:
+                pi[(i, i)] = self.prune_cell(pi[(i, i)])
+
+        # dp, 只遍历左右子节点都在chart中的rule
+        rules_by_left = self.rules_by_left
         for l in xrange(1, n):
             for i in xrange(1, n - l + 1):
                 j = i + l
-
-                for X, YZPairs in SET_X.iteritems():
-                    cur_pi, max_pi = 0.0, -1.0
-                    for (Y, Z) in YZPairs:
-                        for s in xrange(i, j):
-                            # 由于我们用SET_X做了剪枝，所以需要检查是否属于被过滤掉的非法rule
-                            if (i, s, Y) not in pi or (s + 1, j, Z) not in pi:
+                pi_ij, bp_ij = {}, {}
+                for s in xrange(i, j):
+                    right = pi[(s + 1, j)]
+                    for Y, p_Y in pi[(i, s)].iteritems():
+                        by_right = rules_by_left.get(Y)
+                        if by_right is None:
+                            continue
+                        for Z, p_Z in right.iteritems():
+                            rules = by_right.get(Z)
+                            if rules is None:
                                 continue
-                            cur_pi = Decimal(self.q_x_y1y2[(X, Y, Z)]) \
-                                  * pi[(i, s, Y)] \
-                                  * pi[(s + 1, j, Z)]
-                            if cur_pi > max_pi:
-                                max_pi = cur_pi
-                                max_Y, max_Z, max_s = Y, Z, s
-                                pi[(i, j, X)] = max_pi
-                                bp[(i, j, X)] = (max_Y, max_Z, max_s)
-
-        if (1, n, ROOT) not in bp:
-            max_pi = 0.0
-            max_X = ''
-            for X, YZPairs in SET_X.iteritems():
-                if (1, n, X) in pi and pi[(1, n, X)] > max_pi:
-                    max_pi = pi[(1, n, X)]
-                    max_X = X
-        else:
+                            p_YZ = p_Y + p_Z
+                            for X, q in rules:
+                                cur_pi = q + p_YZ
+                                if cur_pi > pi_ij.get(X, LOG_ZERO):
+                                    pi_ij[X] = cur_pi
+                                    bp_ij[X] = (Y, Z, s)
+                self.chart_cells += len(pi_ij)
+                if prune and l < n - 1:
+                    pi_ij = self.prune_cell(pi_ij)
+                pi[(i, j)] = pi_ij
+                bp[(i, j)] = bp_ij
+
+        if instrument.ENABLED:
+            instrument.count('cky_cells', sum(len(cell) for cell in pi.itervalues()))
+        top = pi[(1, n)]
+        if ROOT in top:
             max_X = ROOT
-        result = self.traceback(pi, bp, sentence, 1, n, max_X)
+        elif prune:
+            self.reparses += 1
+            instrument.count('cky_reparses')
+            return self.CKY(sentence, exact=True)
+        elif top:
+            # ties go to the first nonterminal in sorted order, as in CompiledPCFG
+            max_X = max(sorted(top), key=top.get)
+        else:
+            max_X = None
+        if max_X is None:
+            # no parse: each word gets its best preterminal (ROOT if it has none)
+            tags = [max(sorted(pi[(i, i)]), key=pi[(i, i)].get) if pi[(i, i)] else ROOT
+                    for i in xrange(1, n + 1)]
+            result = default_tree(sentence.strip().split(' '), tags)
+        else:
+            result = self.traceback(pi, bp, sentence, 1, n, max_X)
+        if tracing.ENABLED:
+            self.trace_chart(words, pi, bp, result)
         return result
 
+    def prune_cell(self, cell):
+        """
+        keep the beam_size best entries of a chart cell, and/or those within
+        beam_threshold of the best one
+        """
+        if not cell:
+            return cell
+        if self.figure_of_merit:
+            scores = dict((X, p + self.log_prior[X]) for X, p in cell.iteritems())
+        else:
+            scores = cell
+        kept = sorted(scores, key=scores.get, reverse=True)
+        if self.beam_threshold is not None:
+            lowest = scores[kept[0]] - self.beam_threshold
+            kept = [X for X in kept if scores[X] >= lowest]
+        if self.beam_size is not None:
+            kept = kept[:self.beam_size]
+        self.pruned_cells += len(cell) - len(kept)
+        instrument.count('cky_pruned', len(cell) - len(kept))
+        return dict((X, cell[X]) for X in kept)
+
+    def trace_chart(self, words, pi, bp, tree):
+        """
+        record a parsed sentence as trace events: one 'cell' event per
+        chart entry pi(i, j, X) (a log-probability) with its back pointer
+        (Y, Z, s), then a 'sentence' event with the words (rare words
+        mapped) and tree
+        """
+        for (i, j), cell in sorted(pi.iteritems()):
+            for X, p in sorted(cell.iteritems()):
+                tracing.event('cell', i=i, j=j, X=X, pi=p, bp=bp.get((i, j), {}).get(X))
+        tracing.event('sentence', words=words, n=len(words), nonterminals=len(self.nonterm), tree=tree)
+
     def traceback(self, pi, bp, sentence, i, j, X):
         words = sentence.strip().split(' ')
         tree = []
@@ -234,7 +359,7 @@ class CKYTagger(PCFG):
         if i == j:
             tree.append(words[i - 1])
         else:
-            Y1, Y2, s = bp[(i, j, X)]
+            Y1, Y2, s = bp[(i, j)][X]
             # print Y1, Y2, s
             tree.append(self.traceback(pi, bp, sentence, i, s, Y1))
             tree.append(self.traceback(pi, bp, sentence, s + 1, j, Y2))
@@ -0,0 +1,53 @@
+#! /usr/bin/python
+
+import os
+import json
+import atexit
+
+"""
+Structured trace events of the parsers, written as one JSON object per line
+for offline inspection of CKY charts.
+
+The parsers record their chart once per sentence after parsing, guarded by
+a single ENABLED check, so their CKY loops contain no tracing code.
+
+    tracing.start('cky.trace')              # or TRACE_FILE=cky.trace
+    if tracing.ENABLED:
+        tracing.event('cell', i=i, j=j, X=X, pi=pi, bp=bp)
+
+Values json cannot write are written as strings.
+"""
+
+ENABLED = False
+
+_output = None
+
+
+def start(trace_file=None):
+    """
+    write trace events to trace_file (default: environment variable
+    TRACE_FILE), does nothing if neither is given
+    """
+    global ENABLED, _output
+    trace_file = trace_file or os.environ.get('TRACE_FILE')
+    if not trace_file:
+        return
+    if _output is not None:
+        stop()
+    _output = open(trace_file, 'w')
+    ENABLED = True
+    atexit.register(stop)
+
+
+def stop():
+    global ENABLED, _output
+    ENABLED = False
+    if _output is not None:
+        _output.close()
+        _output = None
+
+
+def event(kind, **fields):
+    fields['event'] = kind
+    _output.write(json.dumps(fields, sort_keys=True, default=str))
+    _output.write('\n')
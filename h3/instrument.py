@@ -0,0 +1,109 @@
+#! /usr/bin/python
+
+import os
+import json
+import time
+import atexit
+from collections import defaultdict
+
+"""
+Named stage timers and counters for the drivers.
+
+    with instrument.timer('decode'):
+        tags = tagger.viterbi(sent)
+    instrument.count('sentences')
+
+Nothing is recorded until start() is called, timer() and count() cost a
+function call when instrumentation is off. start() takes the output files,
+or reads them from the environment:
+
+    STATS_FILE=stats.json python p2.py       # timers and counters as JSON
+    PROFILE_FILE=p2.prof python p2.py        # cProfile stats (see pstats)
+
+Both files are written when the process exits.
+"""
+
+ENABLED = False
+
+timers = defaultdict(float)  # timer name -> seconds
+calls = defaultdict(int)  # timer name -> number of timed blocks
+counters = defaultdict(int)  # counter name -> count
+started = None  # time start() was called
+
+
+class Timer(object):
+    """
+    adds the time spent in a with block to timers[name]
+    """
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        timers[self.name] += time.time() - self.start
+        calls[self.name] += 1
+
+
+class NoTimer(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+NO_TIMER = NoTimer()
+
+
+def timer(name):
+    return Timer(name) if ENABLED else NO_TIMER
+
+
+def count(name, n=1):
+    if ENABLED:
+        counters[name] += n
+
+
+def stats():
+    """
+    return the timers and counters recorded so far
+    """
+    return {
+        'total_seconds': time.time() - started if started is not None else 0.0,
+        'timers': dict((name, {'seconds': seconds, 'calls': calls[name]})
+                       for name, seconds in timers.iteritems()),
+        'counters': dict(counters),
+    }
+
+
+def dump(stats_file):
+    json.dump(stats(), open(stats_file, 'w'), indent=2, sort_keys=True)
+
+
+def start(stats_file=None, profile_file=None):
+    """
+    turn on instrumentation if stats_file or profile_file is given
+    (default: environment variables STATS_FILE and PROFILE_FILE)
+    the stats are written to stats_file and the cProfile stats to
+    profile_file at exit
+    """
+    global ENABLED, started
+    stats_file = stats_file or os.environ.get('STATS_FILE')
+    profile_file = profile_file or os.environ.get('PROFILE_FILE')
+    if stats_file:
+        ENABLED = True
+        started = time.time()
+        atexit.register(dump, stats_file)
+    if profile_file:
+        import cProfile
+        profiler = cProfile.Profile()
+        atexit.register(stop_profile, profiler, profile_file)
+        profiler.enable()
+
+
+def stop_profile(profiler, profile_file):
+    profiler.disable()
+    profiler.dump_stats(profile_file)
@@ -1,5 +1,6 @@
 from collections import defaultdict
 import math, sys
+import instrument
 
 
 class IBM1:
@@ -102,14 +103,16 @@ class IBM:
         en = file(en_file, "r")
         es = file(es_file, "r")
 
-        for e, f in zip(en, es):
-            e = ["*"] + e.split(" ")
-            f = f.split(" ")
-            e[-1] = e[-1].strip()
-            f[-1] = f[-1].strip()
-            self.text.append((e, f))
+        with instrument.timer("load"):
+            for e, f in zip(en, es):
+                e = ["*"] + e.split(" ")
+                f = f.split(" ")
+                e[-1] = e[-1].strip()
+                f[-1] = f[-1].strip()
+                self.text.append((e, f))
 
-        self.model.initialize(self.text)
+        with instrument.timer("params"):
+            self.model.initialize(self.text)
 
     def EM(self, iterations=5):
         c_fe = defaultdict(int)
@@ -129,31 +132,37 @@ class IBM:
             t.clear()
             q.clear()
 
-            for fe, (e, f) in enumerate(self.text):
-
-                l = len(e)
-                m = len(f)
-                for i, fword in enumerate(f):
-                    total, vals = self.model.prob_list(fword, e, i, l, m)
-                    for j, eword in enumerate(e):
-                        delta = vals[j] / total
-                        c_fe[fword, eword] += delta
-                        c_e[eword] += delta
-                        c_jilm[j, i, l, m] += delta
-                        c_ilm[i, l, m] += delta
-
-            for fe in c_fe:
-                t[fe] = c_fe[fe] / c_e[fe[1]]
-
-            for j, i, l, m in c_jilm:
-                q[j, i, l, m] = c_jilm[j, i, l, m] / c_ilm[i, l, m]
-
-            self.model.set_t(t)
-            self.model.set_q(q)
-
+            with instrument.timer("count"):
+                for fe, (e, f) in enumerate(self.text):
+
+                    l = len(e)
+                    m = len(f)
+                    for i, fword in enumerate(f):
+                        total, vals = self.model.prob_list(fword, e, i, l, m)
+                        for j, eword in enumerate(e):
+                            delta = vals[j] / total
+                            c_fe[fword, eword] += delta
+                            c_e[eword] += delta
+                            c_jilm[j, i, l, m] += delta
+                            c_ilm[i, l, m] += delta
+                    instrument.count("em_cells", l * m)
+
+            with instrument.timer("params"):
+                for fe in c_fe:
+                    t[fe] = c_fe[fe] / c_e[fe[1]]
+
+                for j, i, l, m in c_jilm:
+                    q[j, i, l, m] = c_jilm[j, i, l, m] / c_ilm[i, l, m]
+
+                self.model.set_t(t)
+                self.model.set_q(q)
+
+            instrument.count("em_iterations")
+            instrument.count("em_sentences", len(self.text))
             print s
 
-        self.model.finalize()
+        with instrument.timer("output"):
+            self.model.finalize()
 
     def read_dev_file(self, en_file, es_file, out_file, invert=False):
 
@@ -168,19 +177,24 @@ class IBM:
             l = len(e)
             m = len(f)
 
-            for i, fword in enumerate(f):
-                total, vals = self.model.prob_list(fword, e, i, l, m)
-                d1 = max(vals, key=(lambda x: vals[x]))
-                print d1
-                if invert:
-                    output.write("%s %s %s\n" % (s + 1, i + 1, d1))
-                else:
-                    output.write("%s %s %s\n" % (s + 1, d1, i + 1))
+            with instrument.timer("decode"):
+                for i, fword in enumerate(f):
+                    total, vals = self.model.prob_list(fword, e, i, l, m)
+                    d1 = max(vals, key=(lambda x: vals[x]))
+                    print d1
+                    if invert:
+                        output.write("%s %s %s\n" % (s + 1, i + 1, d1))
+                    else:
+                        output.write("%s %s %s\n" % (s + 1, d1, i + 1))
+            instrument.count("sentences")
+            instrument.count("tokens", m)
+            instrument.count("alignment_cells", l * m)
 
             output.flush()
 
 
 if __name__ == "__main__":
+    instrument.start()
     model = IBM1()
     mt = IBM(model)
     mt.read_file("corpus.en", "corpus.es")
@@ -4,9 +4,13 @@
 # Date: 2017-03-04 PM10:42
 # Reference: https://github.com/leungwk/nlangp
 import sys
+import multiprocessing
+import instrument
 from collections import defaultdict
 from itertools import product
 
+TAGS = ['I-GENE', 'O']
+
 
 def read_sentences(doc_fpath):
     """where the document separates each token (including newlines) into its own line"""
@@ -161,24 +165,68 @@ def vg(w, u, v, word, dict_tag_model):
     return vg
 
 
-def viterbi(sentence, dict_tag_model):
-    """calculate y^* = \arg\max_{t_1,\dots,t_n \in GEN(x)} f(x,y) \cdot v. x is the sentence history"""
+def transition_scores(dict_tag_model):
+    """
+    trigram feature weights for every (w, u, v), the part of v . g that does
+    not depend on the word; computed once per model and reused by viterbi
+    :param dict_tag_model: tag model
+    :return: dict (w, u, v) -> weight
+    """
+    scores = {}
+    for w, u, v in product(['*'] + TAGS, ['*'] + TAGS, TAGS + ['STOP']):
+        scores[(w, u, v)] = dict_tag_model.get(trigram_feature(w, u, v), 0)
+    return scores
+
+
+def word_scores(word, tags, dict_tag_model):
+    """
+    tag and suffix feature weights of the current word for each tag,
+    the part of v . g that does not depend on the previous tags
+    :param word: current word
+    :param tags: tags of the current word
+    :param dict_tag_model: tag model
+    :return: dict v -> weight
+    """
+    scores = {}
+    for v in tags:
+        scores[v] = sum([dict_tag_model.get(k, 0) for k in [tag_feature(word, v)] + suff_feature(word, v)])
+    return scores
+
+
+def viterbi(sentence, dict_tag_model, transitions=None):
+    """calculate y^* = \arg\max_{t_1,\dots,t_n \in GEN(x)} f(x,y) \cdot v. x is the sentence history
+
+    v . g(t, u, s, word) = transitions[(t, u, s)] + word scores of s
+    (+ the GENE_PUNC weight for punctuation words), so only the word scores
+    are computed per position, once per s.
+    transitions: transition_scores(dict_tag_model), computed here if not given
+    """
+    if transitions is None:
+        transitions = transition_scores(dict_tag_model)
 
     n = len(sentence)
 
-    S = ['I-GENE', 'O']
+    S = TAGS
     pie, bp = {(0, '*', '*'): 0}, {}
 
     def S_(k):
         return ['*'] if k <= 0 else S
 
+    def punc_score(word, t, u, s):
+        punc_feature = gene_punc_feature(word, t, u, s)
+        return punc_feature and dict_tag_model.get(punc_feature, 0) or 0
+
     for k in xrange(1, n + 1):
         word = sentence[k - 1]  # idx-0
+        emission = word_scores(word, S_(k), dict_tag_model)
+        is_punc = gene_punc_feature(word, '*', '*', '*') is not None
         for u, s in product(S_(k - 1), S_(k)):
             ## \max_{w \in S_{k-2}}
             max_val, max_tag = -float('inf'), None
             for t in S_(k - 2):
-                vg_ = vg(t, u, s, word, dict_tag_model)
+                vg_ = transitions[(t, u, s)] + emission[s]
+                if is_punc:
+                    vg_ += punc_score(word, t, u, s)
                 pie_ = pie[(k - 1, t, u)]
                 ## previous most likely sentence so far, then probability of this trigram
                 pkus = pie_ + vg_
@@ -188,10 +236,16 @@ def viterbi(sentence, dict_tag_model):
             idx = (k, u, s)
             pie[idx], bp[idx] = max_val, max_tag
 
+    instrument.count('viterbi_cells', len(pie))
+
     ## calculate for the end of sentence
+    stop = word_scores(word, ['STOP'], dict_tag_model)['STOP']
     max_val, max_tag = -float('inf'), None
     for u, s in product(S_(n - 1), S_(n)):
-        pkus = pie[(n, u, s)] + vg(u, s, 'STOP', word, dict_tag_model)
+        vg_ = transitions[(u, s, 'STOP')] + stop
+        if is_punc:
+            vg_ += punc_score(word, u, s, 'STOP')
+        pkus = pie[(n, u, s)] + vg_
         if pkus > max_val:
             max_val, max_tag = pkus, (u, s)
 
@@ -205,6 +259,63 @@ def viterbi(sentence, dict_tag_model):
     return t
 
 
+_worker_model = None  # tag model of a worker process
+_worker_transitions = None  # transition_scores of the worker's tag model
+
+
+def _init_worker(dict_tag_model):
+    global _worker_model, _worker_transitions
+    _worker_model = dict_tag_model
+    _worker_transitions = transition_scores(dict_tag_model)
+
+
+def _viterbi_worker(sentence):
+    return viterbi(sentence, _worker_model, _worker_transitions)
+
+
+def tag_sentences(sentences, dict_tag_model, processes=1, chunksize=64):
+    """
+    tag sentences, in a pool of processes workers if processes > 1
+    the model is handed to each worker once, tags are yielded in input order
+    :param sentences: list of sentences
+    :param dict_tag_model: tag model
+    :param processes: number of worker processes
+    :param chunksize: sentences sent to a worker at a time
+    :return: iterator over tag sequences
+    """
+    if processes <= 1:
+        transitions = transition_scores(dict_tag_model)
+        for sentence in sentences:
+            yield viterbi(sentence, dict_tag_model, transitions)
+        return
+    pool = multiprocessing.Pool(processes, _init_worker, (dict_tag_model,))
+    try:
+        for tags in pool.imap(_viterbi_worker, sentences, chunksize):
+            yield tags
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+
+def write_tags(sentences, tagged):
+    """
+    write each sentence with its tags from the iterator tagged
+    """
+    tagged = iter(tagged)
+    for sentence in sentences:
+        instrument.count('sentences')
+        instrument.count('tokens', len(sentence))
+        with instrument.timer('decode'):
+            tags = next(tagged)
+        with instrument.timer('output'):
+            for word, tag in zip(sentence, tags):
+                sys.stdout.write('{} {}\n'.format(word, tag))
+            sys.stdout.write('\n')
+
+
 def perceptron(sentences, tag_lines, n_iter):
     model = defaultdict(int)  # v
 
@@ -223,6 +334,7 @@ def perceptron(sentences, tag_lines, n_iter):
             gold_features = feature_vector(gold_tags, sentence)
             best_features = feature_vector(best_tags, sentence)
             if gold_features != best_features:
+                instrument.count('perceptron_updates')
                 ## update weight vector v
                 for key, val in gold_features.iteritems():
                     model[key] += val
@@ -238,36 +350,34 @@ if __name__ == "__main__":
     parser.add_argument('part', help='part to run')  # nargs=1, produces a list, while nothing produes the value itself
     parser.add_argument('--gene-data', help='document of sentences (default: gene.key)', default='gene.key')
     parser.add_argument('--model', help='', default='tag.model')
+    parser.add_argument('--processes', help='number of tagging processes (default: 1)', type=int, default=1)
+    parser.add_argument('--stats', help='write stage timers and counters as JSON to this file at exit')
+    parser.add_argument('--profile', help='write cProfile stats to this file at exit')
     args = parser.parse_args()
+    instrument.start(args.stats, args.profile)
 
     gene_fpath = args.gene_data
 
     if args.part == 'p1':
-        sentences, tag_lines = read_sentence_tags(gene_fpath)
-        dict_tag_model = read_tag_model(args.model)
+        with instrument.timer('load'):
+            sentences, tag_lines = read_sentence_tags(gene_fpath)
+            dict_tag_model = read_tag_model(args.model)
 
-        for sentence in sentences:
-            tags = viterbi(sentence, dict_tag_model)
-            for word, tag in zip(sentence, tags):
-                sys.stdout.write('{} {}\n'.format(word, tag))
-            sys.stdout.write('\n')
+        write_tags(sentences, tag_sentences(sentences, dict_tag_model, args.processes))
 
     elif args.part == 'p2a':
-        sentences, tag_lines = read_sentence_tags(gene_fpath)
-        dict_tag_model = perceptron(sentences, tag_lines, 6)
-        for key, val in dict_tag_model.iteritems():
-            sys.stdout.write('{} {}\n'.format(key, val))
+        with instrument.timer('load'):
+            sentences, tag_lines = read_sentence_tags(gene_fpath)
+        with instrument.timer('params'):
+            dict_tag_model = perceptron(sentences, tag_lines, 6)
+        with instrument.timer('output'):
+            for key, val in dict_tag_model.iteritems():
+                sys.stdout.write('{} {}\n'.format(key, val))
     elif args.part == 'p2b':
-        sentences = read_sentences(gene_fpath)
-        dict_tag_model = read_tag_model(args.model)
+        with instrument.timer('load'):
+            sentences = read_sentences(gene_fpath)
+            dict_tag_model = read_tag_model(args.model)
 
-        xy = []
-        for sentence in sentences:
-            tags = viterbi(sentence, dict_tag_model)
-            xy.append((sentence, tags))
-        for sentence, tags in xy:
-            for word, tag in zip(sentence, tags):
-                sys.stdout.write('{} {}\n'.format(word, tag))
-            sys.stdout.write('\n')
+        write_tags(sentences, tag_sentences(sentences, dict_tag_model, args.processes))
     else:
         raise ValueError('unknown part specified')
@@ -0,0 +1,172 @@
+#! /usr/bin/python
+
+import sys
+import os
+import signal
+import time
+import threading
+import Queue
+import SocketServer
+
+"""
+Tagging server: loads a tagger model once, then tags sentences sent over
+stdin/stdout or over a Unix domain socket.
+
+Sentences use the format of the test files: one token per line, a blank line
+ends a sentence. The reply to a sentence is one "token tag" line per token
+followed by a blank line, written as soon as the sentence is tagged.
+
+Socket clients are served concurrently; their sentences are collected into
+batches of up to BATCH_SIZE sentences (waiting at most MAX_DELAY seconds for
+a batch to fill) and tagged together.
+
+    python tag_server.py glm tag.model
+    python tag_server.py glm tag.model --socket /tmp/tagger.sock
+
+glm models are weight files read by glm.read_tag_model.
+h1/tag_server.py is the same server for compiled HMM models.
+"""
+
+BATCH_SIZE = 64  # sentences tagged at once
+MAX_DELAY = 0.005  # seconds to wait for more sentences before tagging a batch
+
+
+def load_glm(model_filename):
+    """
+    return a function tagging a list of sentences with a GLM tag model
+    """
+    from glm import read_tag_model, transition_scores, viterbi
+    model = read_tag_model(model_filename)
+    transitions = transition_scores(model)
+
+    def tag_batch(sentences):
+        return [viterbi(sentence, model, transitions) for sentence in sentences]
+    return tag_batch
+
+
+LOADERS = {'glm': load_glm}
+
+
+def read_sentences(stream):
+    """
+    return an iterator object that yields one sentence (list of tokens) at a
+    time; lines are read one by one, so a sentence is yielded as soon as its
+    blank line arrives
+    """
+    sentence = []
+    for line in iter(stream.readline, ''):
+        token = line.strip()
+        if token:
+            sentence.append(token)
+        elif sentence:
+            yield sentence
+            sentence = []
+    if sentence:
+        yield sentence
+
+
+def write_tags(stream, sentence, tags):
+    stream.write(''.join('{0} {1}\n'.format(s, t) for s, t in zip(sentence, tags)) + '\n')
+    stream.flush()
+
+
+class Batcher(object):
+    """
+    Collects sentences from concurrent callers of tag() and tags them in
+    batches in a single worker thread.
+    """
+    def __init__(self, tag_batch, batch_size=BATCH_SIZE, max_delay=MAX_DELAY):
+        self.tag_batch = tag_batch
+        self.batch_size = batch_size
+        self.max_delay = max_delay
+        self.requests = Queue.Queue()
+        worker = threading.Thread(target=self.run)
+        worker.daemon = True
+        worker.start()
+
+    def tag(self, sentence):
+        """
+        tag a sentence, blocks until its batch is tagged
+        """
+        request = {'sentence': sentence, 'done': threading.Event()}
+        self.requests.put(request)
+        request['done'].wait()
+        if 'error' in request:
+            raise request['error']
+        return request['tags']
+
+    def run(self):
+        while True:
+            batch = [self.requests.get()]
+            deadline = time.time() + self.max_delay
+            while len(batch) < self.batch_size:
+                timeout = deadline - time.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self.requests.get(timeout=timeout))
+                except Queue.Empty:
+                    break
+            try:
+                results = self.tag_batch([request['sentence'] for request in batch])
+                for request, tags in zip(batch, results):
+                    request['tags'] = tags
+            except Exception as e:
+                for request in batch:
+                    request['error'] = e
+            for request in batch:
+                request['done'].set()
+
+
+class TagHandler(SocketServer.StreamRequestHandler):
+    """
+    Serves one client connection
+    """
+    def handle(self):
+        for sentence in read_sentences(self.rfile):
+            write_tags(self.wfile, sentence, self.server.batcher.tag(sentence))
+
+
+class TagServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socket_path, tag_batch, batch_size=BATCH_SIZE, max_delay=MAX_DELAY):
+        if os.path.exists(socket_path):
+            os.remove(socket_path)  # left over by a previous server
+        SocketServer.UnixStreamServer.__init__(self, socket_path, TagHandler)
+        self.batcher = Batcher(tag_batch, batch_size, max_delay)
+
+
+def serve_stdio(tag_batch, input=sys.stdin, output=sys.stdout):
+    for sentence in read_sentences(input):
+        write_tags(output, sentence, tag_batch([sentence])[0])
+
+
+def serve_socket(tag_batch, socket_path, batch_size=BATCH_SIZE, max_delay=MAX_DELAY):
+    server = TagServer(socket_path, tag_batch, batch_size, max_delay)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))  # clean up the socket file
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        os.remove(socket_path)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description='tag sentences with a model loaded once')
+    parser.add_argument('tagger', choices=sorted(LOADERS), help='model type')
+    parser.add_argument('model', help='model file')
+    parser.add_argument('--socket', help='serve on this Unix domain socket instead of stdin/stdout')
+    parser.add_argument('--batch-size', help='sentences tagged at once (default: %d)' % BATCH_SIZE,
+                        type=int, default=BATCH_SIZE)
+    parser.add_argument('--max-delay', help='seconds to wait for a batch to fill (default: %g)' % MAX_DELAY,
+                        type=float, default=MAX_DELAY)
+    args = parser.parse_args()
+
+    tag_batch = LOADERS[args.tagger](args.model)
+    if args.socket:
+        serve_socket(tag_batch, args.socket, args.batch_size, args.max_delay)
+    else:
+        serve_stdio(tag_batch)